@@ -1,10 +1,10 @@
 import streamlit as st
-import json
-import search
-from sentence_transformers import SentenceTransformer
-import faiss
+import os
+import sharded_search
+import search_service
+import typeahead
 import torch
-from sqlalchemy import create_engine, Column, Integer, String, Table, ForeignKey
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, Table, ForeignKey
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 
 torch.classes.__path__ = []
@@ -30,6 +30,7 @@ class User(Base):
 class Recipe(Base):
     __tablename__ = 'recipes'
     id = Column(Integer, primary_key=True, autoincrement=True)
+    recipe_id = Column(Integer, index=True)  # the stable ID of the recipe in the search index
     title = Column(String)
     ingredients = Column(String)
     directions = Column(String)
@@ -51,24 +52,77 @@ class SearchHistory(Base):
 engine = create_engine('sqlite:///database.db')
 Base.metadata.create_all(engine)
 
+if 'recipe_id' not in [column['name'] for column in inspect(engine).get_columns('recipes')]:
+    with engine.begin() as connection:  # databases created before recipes were saved by ID
+        connection.execute(text('ALTER TABLE recipes ADD COLUMN recipe_id INTEGER'))
+
 Session = sessionmaker(bind=engine)
 session = Session()
 
-st.title('PantryPal')
+search_dir = 'search'
+embedding_cache_db = 'embedding_cache.db'
+completion_limit = 20
+
+
+def artifact_signature(paths: list) -> tuple:
+    """
+    Identify the current version of files on disk, so cached resources are reloaded when the files change.
+    :param paths: The files a cached resource is loaded from.
+    :return: The modification time of each file.
+    """
+    return tuple(os.path.getmtime(path) for path in paths)
+
+
+@st.cache_resource
+def load_search_service(directory: str, embedding_cache_path: str) -> search_service.SearchService:
+    """
+    Create the search service once per server process and share it across sessions, so concurrent searches are
+    encoded and searched in batches, and share the engine's caches of search results and query embeddings. The engine
+    loads its model and artifacts on first use.
+    :param directory: The directory containing the search files.
+    :param embedding_cache_path: The SQLite database in which query embeddings are persisted.
+    :return: The search service.
+    """
+    return search_service.SearchService(
+        sharded_search.open_engine(directory, embedding_cache_path=embedding_cache_path)
+    )
 
-model = SentenceTransformer('all-MiniLM-L6-v2')
-index = faiss.read_index('search/recipe_index.faiss')
-with open('search/recipe_metadata.json', 'r') as f:
-    recipes = json.load(f)
 
-ingredients_json = 'cleaned_ingredients.json'
-dietary_json = 'dietary_restriction_exclusion_lists.json'
+@st.cache_resource(max_entries=4)
+def load_completer(path: str, signature: tuple) -> typeahead.IngredientCompleter:
+    """
+    Build the ingredient completer once per server process and share it across sessions. It completes to canonical
+    ingredients, the same ones the ingredient index uses.
+    :param path: The JSON file with the canonical ingredient vocabulary, as copied to the search directory.
+    :param signature: The artifact_signature() of the file.
+    :return: The completer.
+    """
+    return typeahead.IngredientCompleter.from_vocabulary(path)
+
+
+def ingredient_picker(label: str, find_label: str, key: str, placeholder: str) -> list:
+    """
+    A multiselect of ingredients whose options are the completions of what the user typed into a text box above it,
+    along with the ingredients already selected, so only a few options are sent to the browser however large the
+    vocabulary is.
+    :param label: The label of the multiselect.
+    :param find_label: The label of the text box.
+    :param key: The widget key of the multiselect.
+    :param placeholder: The placeholder of the multiselect.
+    :return: The selected ingredients.
+    """
+    typed = st.text_input(find_label, key=f'{key}_text', placeholder='Start typing an ingredient')
+    selected = st.session_state.get(key, [])
+    options = selected + [name for name in completer.complete(typed, completion_limit) if name not in selected]
+    return st.multiselect(label, options=options, default=selected, key=key, placeholder=placeholder)
 
-with open(ingredients_json, 'r', encoding='utf-8') as f:
-    ingredients = json.load(f)
 
-with open(dietary_json, 'r', encoding='utf-8') as f:
-    dietary = json.load(f)
+st.title('PantryPal')
+
+service = load_search_service(search_dir, embedding_cache_db)
+service.engine.reload_if_changed()
+vocabulary_json = sharded_search.vocabulary_file(search_dir)  # the copy the loaded ingredient index uses
+completer = load_completer(vocabulary_json, artifact_signature([vocabulary_json]))
 
 with st.sidebar:
     username = st.text_input('Username', placeholder='Enter your username')
@@ -112,20 +166,17 @@ with st.sidebar:
         else:
             st.info('No saved recipes yet.')
 
-search_ingredients = st.multiselect(
-        'Ingredients',
-        options=ingredients,
-        placeholder='Select ingredients'
-)
+search_ingredients = ingredient_picker('Ingredients', 'Find ingredients', 'ingredient_picker', 'Select ingredients')
 st.session_state['search_ingredients'] = search_ingredients
 
 selection_type = st.radio(
     'Selection type',
-    options=['Inclusive', 'Exclusive'],
+    options=['Inclusive', 'Exclusive', 'Coverage'],
     index=None,
     horizontal=True,
     help='**Inclusive:** Recipes shown will include ingredients outside of the selected ingredients.\n\n'
-         '**Exclusive:** Recipes shown will only contain ingredients from the selected ingredients.'
+         '**Exclusive:** Recipes shown will only contain ingredients from the selected ingredients.\n\n'
+         '**Coverage:** Recipes shown will be those for which the user has the most ingredients.'
 )
 st.session_state['selection_type'] = selection_type
 
@@ -139,34 +190,39 @@ with st.expander('Additional options', expanded=False):
 
     dietary_restrictions = st.multiselect(
         'Dietary Restrictions',
-        options=dietary.keys(),
+        options=list(service.engine.ingredient_index.restrictions),
         placeholder='Select dietary restrictions'
     )
     st.session_state['dietary_restrictions'] = dietary_restrictions
 
-    avoid_ingredients = st.multiselect(
-        'Avoid list',
-        options=ingredients,
-        placeholder='Select ingredients to avoid'
+    avoid_ingredients = ingredient_picker(
+        'Avoid list', 'Find ingredients to avoid', 'avoid_picker', 'Select ingredients to avoid'
     )
     st.session_state['avoid_ingredients'] = avoid_ingredients
 
-for restriction in dietary_restrictions:
-    for ingredient in dietary[restriction]:
-        avoid_ingredients.append(ingredient)
+    max_missing = st.number_input(
+        'Maximum missing ingredients',
+        min_value=0,
+        value=None,
+        step=1,
+        help='Only show recipes that need at most this many ingredients outside of the selected ingredients.',
+        placeholder='No limit'
+    )
+    st.session_state['max_missing'] = max_missing
 
 if st.button('Search'):
-    results = search.search_faiss_and_filter(
-        model=model,
-        index=index,
-        recipes=recipes,
+    results = service.search(
         user_ingredients=search_ingredients,
         avoid_ingredients=avoid_ingredients,
         user_keywords=search_keywords,
         mode=selection_type.lower(),
-        top_k=10
+        top_k=10,
+        restrictions=dietary_restrictions,
+        max_missing=max_missing
     )
     st.session_state['search_results'] = results
+    if results.exhausted:
+        st.info(f'Only {len(results)} recipes match your search.')
 
 if 'search_results' in st.session_state:
     for i, result in enumerate(st.session_state['search_results']):
@@ -177,9 +233,10 @@ if 'search_results' in st.session_state:
 
             if 'user_id' in st.session_state:
                 if st.button(f'Save recipe', key=f'save_{i}'):
-                    db_recipe = session.query(Recipe).filter_by(title=result['title']).first()
+                    db_recipe = session.query(Recipe).filter_by(recipe_id=result['id']).first()
                     if not db_recipe:
                         new_recipe = Recipe(
+                            recipe_id=result['id'],
                             title=result['title'],
                             ingredients=result['ingredients'],
                             directions=result['directions']
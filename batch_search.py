@@ -0,0 +1,174 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import time
+from collections import deque
+from tqdm import tqdm
+from search import BaseSearchEngine
+from sharded_search import open_engine
+
+SEARCH_ARGS = [
+    "user_ingredients", "avoid_ingredients", "user_keywords", "mode", "top_k", "restrictions", "max_missing"
+]
+
+_engine = None  # the search engine of a worker process
+
+
+def read_queries(input_file: str):
+    """
+    :param input_file: A .jsonl file with one search per line. Every search has user_ingredients and optionally
+    avoid_ingredients, user_keywords, mode, top_k, restrictions and max_missing, as in
+    SearchEngine.search_faiss_and_filter().
+    Other fields, such as a pantry ID, are copied to the output.
+    :return: A generator of the searches.
+    """
+    with open(input_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def search_args(query: dict) -> dict:
+    """
+    :param query: A search read from the input file.
+    :return: The search_faiss_and_filter() keyword arguments of the search.
+    """
+    args = {"avoid_ingredients": [], "user_keywords": ""}
+    args.update((name, query[name]) for name in SEARCH_ARGS if name in query)
+    return args
+
+
+def encode_chunks(engine: BaseSearchEngine, queries, chunk_size: int, batch_size: int):
+    """
+    Encode the texts of every chunk of searches in one batch.
+    :param engine: The search engine whose model encodes the searches.
+    :param queries: An iterable of searches.
+    :param chunk_size: The number of searches per chunk.
+    :param batch_size: The number of texts the model encodes at once.
+    :return: A generator of (searches, their embeddings by text) per chunk.
+    """
+    queries = iter(queries)
+    while chunk := list(itertools.islice(queries, chunk_size)):
+        texts = sorted(set(
+            text for query in chunk for text in engine.query_texts(engine.query_key(**search_args(query)))
+        ))
+        yield chunk, dict(zip(texts, engine.encode(texts, batch_size)))
+
+
+def init_worker(artifact_dir: str) -> None:
+    """
+    Create the search engine of a worker process. The shards of a sharded index are searched one after the other
+    within the worker, since the workers already search in parallel.
+    :param artifact_dir: The directory containing the files written by faiss_index.py.
+    """
+    global _engine
+    _engine = open_engine(artifact_dir, workers=1)
+
+
+def search_chunk(task: tuple, engine: BaseSearchEngine = None) -> list:
+    """
+    Filter and search a chunk of searches in a worker process. The searches arrive encoded, so workers never load
+    the model.
+    :param task: The searches of the chunk and their embeddings by text.
+    :param engine: The search engine to search with, or None for the one of the worker process.
+    :return: Every search, along with its results and exhausted flag.
+    """
+    chunk, query_embeddings = task
+    engine = engine or _engine
+    results = engine.search_many([search_args(query) for query in chunk], query_embeddings=query_embeddings)
+    return [dict(query, results=list(result), exhausted=result.exhausted) for query, result in zip(chunk, results)]
+
+
+def batch_search(input_file: str, output_file: str, artifact_dir: str = "search", workers: int = 1,
+                 chunk_size: int = 256, batch_size: int = 256) -> None:
+    """
+    Run every search of a .jsonl file and write the results to a .jsonl file, in input order.
+    The main process encodes the searches chunk by chunk while a pool of worker processes filters and searches the
+    chunks encoded before. At most two chunks per worker are encoded ahead, so memory is bounded by the chunk size
+    rather than the file size. Every worker loads the artifacts itself, and the memory-mapped ones are shared.
+    :param input_file: A .jsonl file with one search per line, see read_queries().
+    :param output_file: A .jsonl file to write every search to, along with its results and exhausted flag.
+    :param artifact_dir: The directory containing the files written by faiss_index.py.
+    :param workers: The number of processes filtering and searching in parallel.
+    :param chunk_size: The number of searches encoded and searched at once.
+    :param batch_size: The number of texts the model encodes at once.
+    """
+    engine = open_engine(artifact_dir)
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(artifact_dir,)) if workers > 1 else None
+    pending = deque()
+    count = 0
+    start = time.perf_counter()
+
+    def write(chunk: list) -> None:
+        nonlocal count
+        for line in chunk:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        count += len(chunk)
+        progress.update(len(chunk))
+
+    try:
+        with open(output_file, "w", encoding="utf-8") as f, tqdm(desc="Searching", unit="query") as progress:
+            # encodes the next chunks while the workers search
+            for task in encode_chunks(engine, read_queries(input_file), chunk_size, batch_size):
+                if pool is None:
+                    write(search_chunk(task, engine))
+                    continue
+                pending.append(pool.apply_async(search_chunk, (task,)))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().get())  # in input order
+            while pending:
+                write(pending.popleft().get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.perf_counter() - start
+    print(f"Searched {count} queries in {elapsed:.1f}s ({count / elapsed:.1f} queries/s).")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='batch_search.py',
+        description='Run the searches of a jsonl file and write their results to a jsonl file.'
+    )
+    parser.add_argument(
+        'input_file',
+        type=str,
+        help='A jsonl file with one search per line, each with user_ingredients and optionally avoid_ingredients, '
+             'user_keywords, mode, top_k, restrictions and max_missing.'
+    )
+    parser.add_argument(
+        'output_file',
+        type=str,
+        help='The jsonl file in which every search and its results should be written.'
+    )
+    parser.add_argument(
+        '-d', '--artifact_dir',
+        type=str,
+        default='search',
+        help='The directory containing the index and metadata written by faiss_index.py.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='The number of processes filtering and searching in parallel.'
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=256,
+        help='The number of searches encoded and searched at once.'
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=256,
+        help='The number of texts the model encodes at once.'
+    )
+    args = parser.parse_args()
+
+    batch_search(args.input_file, args.output_file, args.artifact_dir, args.workers, args.chunk_size,
+                 args.batch_size)
@@ -16,44 +16,44 @@ ingredients_remove_list = [
 ]
 
 
+# every list compiled into one alternation, so each recipe is searched once per field
+title_pattern = re.compile('|'.join(title_remove_list))
+ingredients_pattern = re.compile('|'.join(ingredients_remove_list))
+
+
+def is_edible(recipe: dict) -> bool:
+    """
+    :param recipe: A recipe with a title and newline-separated ingredient lines.
+    :return: Whether the recipe passes the inedible-recipe filters.
+    """
+    return not (title_pattern.search(recipe['title'].lower()) or
+                ingredients_pattern.search(recipe['ingredients'].lower()))
+
+
 def clean_recipes(jsonl_input: str, jsonl_output: str) -> None:
     """
-    Remove recipes that are inedible.
+    Remove recipes that are inedible, streaming them from the input file to the output file.
     :param jsonl_input: 'A .jsonl file containing the raw recipes.'
     :param jsonl_output: 'A .jsonl file in which the cleaned recipes should be written.'
     """
-    recipes = []
-    cleaned_recipes = []
+    removed = 0
 
-    with open(jsonl_input, 'r', encoding='utf-8') as f:
+    with open(jsonl_input, 'r', encoding='utf-8') as f, open(jsonl_output, 'w', encoding='utf-8') as out:
         for line in f:
-            recipes.append(json.loads(line))
-
-    for recipe in recipes:
-        recipe_name = recipe['title'].lower()
-        recipe_ingredients = recipe['ingredients'].lower()
-
-        if any(re.search(keyword, recipe_name) for keyword in title_remove_list):
-            print(recipe_name)
-            continue
-
-        if any(re.search(keyword, recipe_ingredients) for keyword in ingredients_remove_list):
-            print(recipe_ingredients)
-            continue
-
-        cleaned_recipes.append(recipe)
-
-    with open(jsonl_output, 'w', encoding='utf-8') as f:
-        for recipe in cleaned_recipes:
-            f.write(json.dumps(recipe) + '\n')
+            recipe = json.loads(line)
+            if not is_edible(recipe):
+                print(recipe['title'].lower())
+                removed += 1
+                continue
+            out.write(json.dumps(recipe) + '\n')
 
-    print(f'Removed {len(recipes) - len(cleaned_recipes)} recipes.')
+    print(f'Removed {removed} recipes.')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        prog='extract_ingredients.py',
-        description='Extract ingredients from a file containing measurements.'
+        prog='cleanup.py',
+        description='Remove inedible recipes from a file containing recipes.'
     )
     parser.add_argument(
         'input_jsonl',
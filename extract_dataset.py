@@ -1,114 +1,112 @@
 import argparse
+import ast
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import json
 import os
 from tqdm import tqdm
 from collections import Counter
 
 
-def extract_data(input_file: str, output_dir: str) -> None:
-    """
-    From the dataset, extract the data into JSON files for easier access.
-    :param input_file: A string representing the name of the input file containing the raw dataset.
-    :param output_dir: A string representing the output directory.
-    """
-    file_name = os.path.splitext(args.input_csv)[0]
+CHUNK_SIZE = 10000  # recipes read from the .csv file and written as one Parquet row group
+LIST_COLUMNS = {'ingredients': 'measurements', 'directions': 'directions', 'NER': 'ingredients'}
+SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('recipe_name', pa.string()),
+    ('measurements', pa.list_(pa.string())),
+    ('directions', pa.list_(pa.string())),
+    ('link', pa.string()),
+    ('source', pa.string()),
+    ('ingredients', pa.list_(pa.string()))
+])
 
-    # get the total number of recipes for tqdm
-    with open(input_file, 'r', encoding='utf-8') as f:
-        total_rows = sum(1 for _ in f) - 1
 
-    chunk_size = 10000
-    total_chunks = (total_rows // chunk_size) + 1
-
-    recipes_dict = {}
-    measurements_dict = {}
-    directions_dict = {}
-    ingredients_dict = {}
+def parse_list(text) -> list:
+    """
+    Parse a stringified list of the dataset. Lists are written as JSON, so json.loads() is tried first, and lists
+    quoted like Python literals are parsed safely with ast.literal_eval().
+    :param text: A stringified list, or a missing value.
+    :return: The list, empty for a missing value or a blank string.
+    """
+    if not isinstance(text, str) or not text.strip():
+        return []
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return ast.literal_eval(text)
 
-    use_cols = ['Unnamed: 0', 'title', 'ingredients', 'directions', 'link', 'source', 'NER']
 
-    tqdm_iter = tqdm(
-        pd.read_csv(input_file, usecols=use_cols, chunksize=chunk_size),
-        desc='Extracting recipes',
-        total=total_chunks,
-        unit='chunk'
-    )
+def parse_list_column(column: pd.Series) -> list:
+    """
+    Parse a column of stringified lists with one json.loads() call for the whole column, falling back to parsing the
+    lists one by one if any of them is not valid JSON.
+    :param column: A column of stringified lists.
+    :return: The lists.
+    """
+    if column.map(lambda text: isinstance(text, str)).all():
+        try:
+            return json.loads('[' + ','.join(column) + ']')
+        except json.JSONDecodeError:
+            pass
+    return [parse_list(text) for text in column]
 
-    for chunk in tqdm_iter:
-        for _, row in chunk.iterrows():
-            recipe_id = str(row['Unnamed: 0'])
-            measurements = eval(row['ingredients']) if isinstance(row['ingredients'], str) else row['ingredients']
-            directions = eval(row['directions']) if isinstance(row['directions'], str) else row['directions']
-            ingredients = eval(row['NER']) if isinstance(row['NER'], str) else row['NER']
-
-            recipes_dict[recipe_id] = {
-                'recipe_name': row['title'],
-                'measurements': measurements,
-                'directions': directions,
-                'link': row['link'],
-                'source': row['source'],
-                'ingredients': ingredients
-            }
 
-            measurements_dict[recipe_id] = {
-                'measurements': measurements
-            }
+def extract_data(input_file: str, output_dir: str, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    From the dataset, extract the data into one Parquet file for easier access, in a single streaming pass. Every
+    chunk of the .csv file is parsed and written as a row group, so memory does not grow with the dataset.
+    :param input_file: A string representing the name of the input file containing the raw dataset.
+    :param output_dir: A string representing the output directory.
+    :param chunk_size: The number of recipes read and written at once.
+    :return: The path of the Parquet file, with the columns id, recipe_name, measurements, directions, link, source
+    and ingredients, where measurements, directions and ingredients are lists of strings.
+    """
+    file_name = os.path.splitext(os.path.basename(input_file))[0]
+    output_file = f'{output_dir}/{file_name}_recipes.parquet'
 
-            directions_dict[recipe_id] = {
-                'directions': directions
-            }
+    use_cols = ['Unnamed: 0', 'title', 'ingredients', 'directions', 'link', 'source', 'NER']
 
-            ingredients_dict[recipe_id] = {
-                'ingredients': ingredients
+    with pq.ParquetWriter(output_file, SCHEMA) as writer, \
+            tqdm(desc='Extracting recipes', unit='recipe') as progress:
+        for chunk in pd.read_csv(input_file, usecols=use_cols, chunksize=chunk_size):
+            chunk = chunk.astype(object).where(chunk.notna(), None)  # missing values are written as nulls
+            columns = {
+                'id': chunk['Unnamed: 0'].tolist(),
+                'recipe_name': chunk['title'].tolist(),
+                'link': chunk['link'].tolist(),
+                'source': chunk['source'].tolist()
             }
+            for csv_column, column in LIST_COLUMNS.items():
+                columns[column] = parse_list_column(chunk[csv_column])
 
-    with open(f'{output_dir}/{file_name}_recipes.json', 'w', encoding='utf-8') as f:
-        json.dump(recipes_dict, f, ensure_ascii=False, indent=2)
-
-    print('Recipes extracted successfully.')
-
-    with open(f'{output_dir}/{file_name}_measurements.json', 'w', encoding='utf-8') as f:
-        json.dump(measurements_dict, f, ensure_ascii=False, indent=2)
-
-    print('Measurements extracted successfully.')
-
-    with open(f'{output_dir}/{file_name}_directions.json', 'w', encoding='utf-8') as f:
-        json.dump(directions_dict, f, ensure_ascii=False, indent=2)
-
-    print('Directions extracted successfully.')
-
-    with open(f'{output_dir}/{file_name}_ingredients.json', 'w', encoding='utf-8') as f:
-        json.dump(ingredients_dict, f, ensure_ascii=False, indent=2)
-
-    print('Ingredients extracted successfully.')
+            writer.write_table(pa.table(columns, schema=SCHEMA))
+            progress.update(len(chunk))
 
     print('Data extraction complete!')
+    return output_file
 
 
-def extract_unique_ingredients(json_file: str, output_dir: str) -> None:
+def extract_unique_ingredients(parquet_file: str, output_dir: str) -> None:
     """
-    From the JSON file containing the ingredients for each recipe, extract the unique ingredients and their counts.
-    :param json_file: A string representing the name of the JSON file containing the full list of ingredients.
+    From the Parquet file written by extract_data(), extract the unique ingredients and their counts. Only the
+    ingredients column is read, one row group at a time.
+    :param parquet_file: A string representing the name of the Parquet file containing the ingredients of every recipe.
     :param output_dir: A string representing the output directory.
     """
-    file_name = os.path.splitext(args.input_csv)[0]
+    file_name = os.path.basename(parquet_file).removesuffix('_recipes.parquet')
 
     ingredients_counter = Counter()
+    recipes = pq.ParquetFile(parquet_file)
 
-    with open(json_file, 'r', encoding='utf-8') as f:
-        ingredients_dict = json.load(f)
-
-        tqdm_iter = tqdm(
-            ingredients_dict.items(),
-            desc='Extracting unique ingredients',
-            total=len(ingredients_dict),
-            unit='ingredient'
-        )
-
-        for _, value in tqdm_iter:
-            for ingredient in value['ingredients']:
-                ingredients_counter[ingredient] += 1
+    with tqdm(desc='Extracting unique ingredients', total=recipes.metadata.num_rows, unit='recipe') as progress:
+        for batch in recipes.iter_batches(columns=['ingredients']):
+            counts = pc.value_counts(batch.column('ingredients').flatten())
+            ingredients_counter.update(
+                dict(zip(counts.field('values').to_pylist(), counts.field('counts').to_pylist()))
+            )
+            progress.update(batch.num_rows)
 
     print(f'# of total ingredients: {ingredients_counter.total()}')
     print(f'# of unique ingredients: {len(ingredients_counter)}')
@@ -141,19 +139,25 @@ if __name__ == '__main__':
     parser.add_argument(
         '-g', '--get_unique_ingredients',
         action='store_true',
-        help='A boolean determining whether unique ingredients should be extracted from ingredients.json.'
+        help='A boolean determining whether unique ingredients should be extracted from the extracted recipes.'
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=CHUNK_SIZE,
+        help='The number of recipes read from the .csv file and written to the Parquet file at once.'
     )
     args = parser.parse_args()
 
-    file_name = os.path.splitext(args.input_csv)[0]
+    file_name = os.path.splitext(os.path.basename(args.input_csv))[0]
 
     if args.extract_data:
-        extract_data(args.input_csv, args.output_dir)
+        extract_data(args.input_csv, args.output_dir, args.chunk_size)
 
-    ingredients_json = f'{args.output_dir}/{file_name}_ingredients.json'
+    recipes_parquet = f'{args.output_dir}/{file_name}_recipes.parquet'
 
     if args.get_unique_ingredients:
-        if os.path.exists(ingredients_json):
-            extract_unique_ingredients(ingredients_json, args.output_dir)
+        if os.path.exists(recipes_parquet):
+            extract_unique_ingredients(recipes_parquet, args.output_dir)
         else:
             print(f'No unique ingredients found for {file_name}.')
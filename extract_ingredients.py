@@ -1,7 +1,12 @@
 import re
 import json
 import argparse
-from collections import Counter
+import itertools
+import multiprocessing
+import time
+from collections import Counter, deque
+from functools import lru_cache
+from tqdm import tqdm
 
 units = {'c', 'cup', 'cups', 't', 'tsp', 'teaspoon', 'teaspoons', 'tbsp', 'tablespoon', 'tablespoons',
          'oz', 'ounce', 'ounces', 'lb', 'lbs', 'pound', 'pounds', 'can', 'cans', 'jar', 'jars',
@@ -15,15 +20,87 @@ units = {'c', 'cup', 'cups', 't', 'tsp', 'teaspoon', 'teaspoons', 'tbsp', 'table
 phrases = {'to taste', 'for garnish', 'if desired', 'as desired', 'to cover top'}
 
 
+NORMALIZER_CACHE_SIZE = 65536  # distinct measurements memoized, e.g. "1 c. sugar" repeats across many recipes
+
+# the patterns applied in order by extract_ingredients(), compiled once
+bracketed = re.compile(r'[\(\[].*?[\)\]]')
+phrase_pattern = re.compile(r'\b(?:' + '|'.join(re.escape(phrase) for phrase in sorted(phrases)) + r')\b')
+digits = re.compile(r'\d+(?!-[a-z])')
+invalid_chars = re.compile(r"[^a-z0-9\-\s,'&]")
+edge_words = {'of', 'or', '-'}
+
+
 def remove_phrases(text: str) -> str:
     """
     For each measurement, remove unnecessary phrases to retain just the ingredient.
     :param text: A measurement containing an ingredient.
     :return: Text with the phrase removed.
     """
-    for phrase in phrases:
-        text = re.sub(r'\b' + re.escape(phrase) + r'\b', '', text)
-    return text
+    return phrase_pattern.sub('', text)
+
+
+class IngredientNormalizer:
+    """
+    Extracts ingredients from measurements with precompiled patterns, memoizing the ingredient of the most recently
+    used measurements, since the same measurements repeat across recipes.
+    """
+
+    def __init__(self, cache_size: int = NORMALIZER_CACHE_SIZE):
+        """
+        :param cache_size: The maximum number of measurements whose ingredient is memoized.
+        """
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    @staticmethod
+    def _normalize(line: str) -> str:
+        """
+        Extract the ingredient by removing numbers and units.
+        :param line: A measurement containing an ingredient.
+        :return: The extracted ingredient.
+        """
+        text = line.lower()
+
+        if ',' in text:
+            text = text.split(',')[0]
+
+        text = bracketed.sub('', text)
+        text = phrase_pattern.sub('', text)
+        text = digits.sub('', text)
+        tokens = invalid_chars.sub('', text).split()
+
+        last = len(tokens) - 1
+        filtered = [tok for i, tok in enumerate(tokens) if tok not in units or i == last]
+
+        if filtered and filtered[0] in edge_words:
+            filtered = filtered[1:]
+
+        if filtered and (filtered[-1] == 'of' or filtered[-1] == 'or' or filtered[0] == '-'):
+            filtered = filtered[:-1]
+
+        return ' '.join(filtered)
+
+    def normalize_many(self, lines):
+        """
+        Extract the ingredients of many measurements, normalizing every distinct measurement once.
+        :param lines: A list or pandas Series of measurements.
+        :return: The extracted ingredients, as a list for a list and as a Series with the same index for a Series.
+        """
+        ingredients = dict.fromkeys(lines)
+        for line in ingredients:
+            ingredients[line] = self.normalize(line)
+
+        if hasattr(lines, 'map'):  # a pandas Series, mapped in one vectorized lookup
+            return lines.map(ingredients)
+        return [ingredients[line] for line in lines]
+
+    def cache_info(self):
+        """
+        :return: The hits, misses and size of the memoized measurements.
+        """
+        return self.normalize.cache_info()
+
+
+normalizer = IngredientNormalizer()
 
 
 def extract_ingredients(line: str) -> str:
@@ -32,33 +109,94 @@ def extract_ingredients(line: str) -> str:
     :param line: A measurement containing an ingredient.
     :return: The extracted ingredient.
     """
-    text = line.lower()
+    return normalizer.normalize(line)
 
-    if ',' in text:
-        text = text.split(',')[0]
 
-    text = re.sub(r'[\(\[].*?[\)\]]', '', text)
+def read_measurements(input_file: str, chunk_size: int = 10000):
+    """
+    Read the measurements of recipes chunk by chunk.
+    .jsonl files have one recipe per line and .parquet files one recipe per row, each with a list of measurements in
+    "measurements", and are streamed. .json files map recipe IDs to recipes, like the measurements file written by
+    extract_dataset.py, and are loaded at once.
+    :param input_file: A .jsonl, .parquet or .json file containing the measurements of every recipe.
+    :param chunk_size: The number of recipes per chunk.
+    :return: A generator of the measurements of every chunk, as one list, along with its number of recipes.
+    """
+    if input_file.endswith('.parquet'):
+        import pyarrow.parquet as pq
 
-    text = remove_phrases(text)
+        for batch in pq.ParquetFile(input_file).iter_batches(batch_size=chunk_size, columns=['measurements']):
+            yield batch.column('measurements').flatten().to_pylist(), batch.num_rows
+        return
 
-    text = re.sub(r'\d+(?!-[a-z])', '', text)
-    text = re.sub(r"[^a-z0-9\-\s,'&]", '', text)
-    text = re.sub(r'\s+', ' ', text).strip()
+    if input_file.endswith('.jsonl'):
+        with open(input_file, 'r', encoding='utf-8') as f:
+            recipes = (json.loads(line) for line in f if line.strip())
+            while chunk := list(itertools.islice(recipes, chunk_size)):
+                yield [measurement for recipe in chunk for measurement in recipe['measurements']], len(chunk)
+        return
 
-    tokens = text.split()
+    with open(input_file, 'r', encoding='utf-8') as f:
+        recipes = list(json.load(f).values())
+    for i in range(0, len(recipes), chunk_size):
+        chunk = recipes[i:i + chunk_size]
+        yield [measurement for recipe in chunk for measurement in recipe['measurements']], len(chunk)
 
-    filtered = [
-        tok for i, tok in enumerate(tokens)
-        if not (tok in units and not (tok in units and i == len(tokens) - 1))
-    ]
 
-    if filtered and (filtered[0] == 'of' or filtered[0] == 'or' or filtered[0] == '-'):
-        filtered = filtered[1:]
+def count_chunk(task: tuple) -> tuple:
+    """
+    Count the ingredients of a chunk of recipes, in a worker process or the main one.
+    :param task: The measurements of the chunk and its number of recipes.
+    :return: The number of times every ingredient occurs, and the number of recipes.
+    """
+    measurements, recipe_count = task
+    return Counter(ingredient for ingredient in normalizer.normalize_many(measurements) if ingredient), recipe_count
 
-    if filtered and (filtered[-1] == 'of' or filtered[-1] == 'or' or filtered[0] == '-'):
-        filtered = filtered[:-1]
 
-    return ' '.join(filtered)
+def count_ingredients(input_file: str, workers: int = 1, chunk_size: int = 10000) -> Counter:
+    """
+    Count how often every ingredient occurs in the measurements of a file. Chunks of recipes are fanned out to a pool
+    of worker processes, and at most two chunks per worker are read ahead, so memory is bounded by the chunk size
+    rather than the file size (except for .json files, which are loaded at once).
+    :param input_file: A .jsonl, .parquet or .json file containing the measurements of every recipe, see
+    read_measurements().
+    :param workers: The number of processes normalizing in parallel.
+    :param chunk_size: The number of recipes per chunk.
+    :return: The number of times every ingredient occurs, in order of first occurrence.
+    """
+    ingredient_counts = Counter()
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    pending = deque()
+    recipes = 0
+    start = time.perf_counter()
+
+    def merge(result: tuple) -> None:
+        nonlocal recipes
+        counts, recipe_count = result
+        ingredient_counts.update(counts)
+        recipes += recipe_count
+        progress.update(recipe_count)
+
+    try:
+        with tqdm(desc='Extracting ingredients', unit='recipe') as progress:
+            for task in read_measurements(input_file, chunk_size):
+                if pool is None:
+                    merge(count_chunk(task))
+                    continue
+                pending.append(pool.apply_async(count_chunk, (task,)))
+                if len(pending) >= 2 * workers:
+                    merge(pending.popleft().get())  # in input order, so the counts are ordered as without workers
+            while pending:
+                merge(pending.popleft().get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.perf_counter() - start
+    print(f'Extracted {len(ingredient_counts)} ingredients from {recipes} recipes in {elapsed:.1f}s '
+          f'({recipes / elapsed:.1f} recipes/s).')
+    return ingredient_counts
 
 
 if __name__ == '__main__':
@@ -69,27 +207,28 @@ if __name__ == '__main__':
     parser.add_argument(
         'input_json',
         type=str,
-        help='A .json file containing the measurements.'
+        help='A .jsonl, .parquet or .json file containing the measurements. .jsonl and .parquet files are streamed.'
     )
     parser.add_argument(
         'output_json',
         type=str,
         help='A .json file in which the extracted ingredients should be written.'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='The number of processes extracting ingredients in parallel.'
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=10000,
+        help='The number of recipes read and extracted at once.'
+    )
     args = parser.parse_args()
 
-    json_file = args.input_json
-    output_file = args.output_json
-    ingredients_dict = Counter()
-
-    with open(json_file, 'r', encoding='utf-8') as f:
-        recipes_dict = json.load(f)
-
-    for recipe_id, measurements in recipes_dict.items():
-        for measurement in measurements['measurements']:
-            ingredient = extract_ingredients(measurement)
-            if ingredient:
-                ingredients_dict[ingredient] += 1
+    ingredients_dict = count_ingredients(args.input_json, args.workers, args.chunk_size)
 
-    with open(output_file, 'w', encoding='utf-8') as f:
+    with open(args.output_json, 'w', encoding='utf-8') as f:
         json.dump(ingredients_dict, f, indent=2, ensure_ascii=False)
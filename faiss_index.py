@@ -2,61 +2,862 @@ from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 import json
+import os
+import time
+import itertools
 import argparse
+from tqdm import tqdm
+from ingredient_index import IngredientIndex, normalize_restrictions
+from recipe_store import RecipeStore, RecipeStoreWriter
+from vocabulary import Vocabulary
+from sharded_search import SHARDS_FILE, SHARD_DIR, read_shards
+from search import MODEL_NAME, INDEX_FILE, CONFIG_FILE, EMBEDDINGS_FILE, PRECISIONS, search_parameters, \
+    QuantizedEmbeddings, load_embeddings, embedding_scale, quantize_embeddings
 
+INDEX_TYPES = ['flat', 'ivf', 'ivfpq', 'hnsw']
+SQ_TYPES = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}  # how vectors of each precision are stored
+REPORT_FILE = "index_report.json"
+CHECKPOINT_FILE = "build_checkpoint.json"
+ADD_BATCH_SIZE = 65536  # embeddings copied from the memory-mapped matrix into the index at once
 
-def index_faiss(input_file: str, output_dir: str) -> None:
+
+def create_index(embeddings: np.ndarray, index_type: str = "flat", nlist: int = None, nprobe: int = 16,
+                 pq_m: int = 48, pq_nbits: int = 8, hnsw_m: int = 32, ef_construction: int = 200,
+                 ef_search: int = 64, precision: str = "float32") -> tuple:
+    """
+    Create and fill a FAISS index of the given type. The index ranks by inner product, which is the cosine
+    similarity of the normalized embeddings.
+    :param embeddings: The normalized embeddings to add to the index, which may be memory-mapped.
+    :param index_type: One of flat (exact search), ivf (IVF-Flat), ivfpq (IVF-PQ) or hnsw.
+    :param nlist: Number of IVF clusters. Defaults to 4 * sqrt(number of embeddings).
+    :param nprobe: Number of IVF clusters visited per search.
+    :param pq_m: Number of PQ sub-quantizers. Must divide the embedding dimension.
+    :param pq_nbits: Number of bits per PQ sub-quantizer code.
+    :param hnsw_m: Number of neighbours per HNSW node.
+    :param ef_construction: Size of the HNSW candidate list while building.
+    :param ef_search: Size of the HNSW candidate list while searching.
+    :param precision: How the vectors of flat, ivf and hnsw indexes are stored: float32, float16 or int8 (scalar
+    quantized per dimension). The embedding matrix is stored in the same precision, see store_embeddings().
+    :return: The index, and its config with the type and the search-time parameters.
+    """
+    n, dim = embeddings.shape
+    config = {"index_type": index_type, "dim": dim, "metric": "inner_product", "precision": precision}
+    storage = SQ_TYPES[precision]
+
+    if index_type == "flat":
+        index = faiss.index_factory(dim, storage, faiss.METRIC_INNER_PRODUCT)
+
+    elif index_type in ("ivf", "ivfpq"):
+        nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        if index_type == "ivf":
+            index = faiss.index_factory(dim, f"IVF{nlist},{storage}", faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.index_factory(dim, f"IVF{nlist},PQ{pq_m}x{pq_nbits}", faiss.METRIC_INNER_PRODUCT)
+            config.update(pq_m=pq_m, pq_nbits=pq_nbits)
+        config.update(nlist=nlist, nprobe=min(nprobe, nlist))
+
+    elif index_type == "hnsw":
+        suffix = "" if precision == "float32" else f",{storage}"
+        index = faiss.index_factory(dim, f"HNSW{hnsw_m}{suffix}", faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        config.update(hnsw_m=hnsw_m, efConstruction=ef_construction, efSearch=ef_search)
+
+    else:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}.")
+
+    if not index.is_trained:  # IVF clusters, PQ codebooks and int8 value ranges
+        # faiss warns below ~40 points per IVF cluster, more doesn't help much
+        train_size = min(n, nlist * 256 if nlist else ADD_BATCH_SIZE)
+        sample = np.random.default_rng(0).choice(n, train_size, replace=False)
+        index.train(np.ascontiguousarray(embeddings[np.sort(sample)]))
+
+    for i in range(0, n, ADD_BATCH_SIZE):
+        index.add(np.ascontiguousarray(embeddings[i:i + ADD_BATCH_SIZE]))
+
+    return index, config
+
+
+def exact_neighbours(queries: np.ndarray, embeddings: np.ndarray, k: int, transform: callable = None) -> np.ndarray:
+    """
+    Find the exact top k embeddings by inner product for every query, reading the embeddings in batches and keeping
+    a running top k per query, so no copy of the matrix is held in memory.
+    :param queries: The float32 queries.
+    :param embeddings: The embeddings to search, which may be memory-mapped.
+    :param k: The number of neighbours to find.
+    :param transform: An optional function applied to every batch of embeddings before it is searched.
+    :return: The positions of the neighbours of every query, -1 where there are fewer than k embeddings.
+    """
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    rows = np.arange(len(queries))[:, None]
+    for i in range(0, len(embeddings), ADD_BATCH_SIZE):
+        batch = np.asarray(embeddings[i:i + ADD_BATCH_SIZE], dtype=np.float32)
+        if transform is not None:
+            batch = transform(batch)
+        scores = np.hstack([best_scores, queries @ batch.T])
+        ids = np.hstack([best_ids, np.broadcast_to(np.arange(i, i + len(batch)), (len(queries), len(batch)))])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores, best_ids = scores[rows, top], ids[rows, top]
+    return best_ids
+
+
+def evaluate_index(index, config: dict, embeddings: np.ndarray, k: int = 10, num_queries: int = 200) -> dict:
+    """
+    Measure the recall@k and query latency of an index against exact search over the same float32 embeddings. For
+    reduced precision, also measure the recall@k of exact search over the embeddings as stored for re-ranking, and
+    the memory of the index and the embedding matrix compared to float32. Exact search reads the embeddings in
+    batches, see exact_neighbours(), so evaluating stays within the memory of a build.
+    :param index: The index to evaluate.
+    :param config: The index config, for the search-time parameters and the precision.
+    :param embeddings: The float32 embeddings in the index, used for the exact baseline, which may be memory-mapped.
+    :param k: The number of neighbours to compare.
+    :param num_queries: The number of recipes, sampled from the corpus, used as queries.
+    :return: The report.
+    """
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)
+    queries = np.ascontiguousarray(embeddings[np.sort(sample)])
+
+    start = time.perf_counter()
+    truth = exact_neighbours(queries, embeddings, k)
+    flat_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k, params=search_parameters(config))
+    index_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits = sum(len(set(f[f >= 0]).intersection(t)) for f, t in zip(found, truth))
+    precision = config.get("precision", "float32")
+
+    report = {
+        "index_type": config["index_type"],
+        "precision": precision,
+        "k": k,
+        "num_queries": len(queries),
+        "recall": hits / truth.size,
+        "latency_ms": index_ms,
+        "flat_latency_ms": flat_ms,
+        "index_bytes": len(faiss.serialize_index(index)),
+        "float32_vector_bytes": embeddings.size * 4,
+        "embedding_bytes": embeddings.size * np.dtype(PRECISIONS[precision]).itemsize
+    }
+
+    if precision != "float32":
+        scale = np.array(config["embedding_scale"], dtype=np.float32) if "embedding_scale" in config else None
+        reranked = exact_neighbours(
+            queries, embeddings, k,
+            transform=lambda batch: QuantizedEmbeddings(quantize_embeddings(batch, precision, scale), scale)[:]
+        )
+        report["embedding_recall"] = sum(len(set(f).intersection(t)) for f, t in zip(reranked, truth)) / truth.size
+
+    return report
+
+
+def recipe_text(recipe: dict) -> str:
+    """
+    :param recipe: A recipe.
+    :return: The text that is embedded for the recipe.
+    """
+    return f"{recipe['title']}: {recipe['ingredients']}\n{recipe['directions']}"
+
+
+def encode_texts(model, texts: list, batch_size: int, pool=None) -> np.ndarray:
+    """
+    Encode texts into normalized embeddings.
+    :param model: The embedding model.
+    :param texts: The texts to encode.
+    :param batch_size: The number of texts the model encodes at once.
+    :param pool: An optional multi-process pool from model.start_multi_process_pool().
+    :return: The float32 embeddings.
+    """
+    if pool is not None:
+        emb = model.encode_multi_process(texts, pool, batch_size=batch_size, normalize_embeddings=True)
+    else:
+        emb = model.encode(texts, batch_size=batch_size, normalize_embeddings=True, show_progress_bar=False)
+    return emb.astype("float32")
+
+
+def read_recipes(input_file: str, skip: int = 0, shard: int = 0, shards: int = 1):
+    """
+    Read recipes from a .jsonl file one at a time.
+    :param input_file: Input .jsonl file containing the recipes.
+    :param skip: The number of recipes to skip from the start of the file, or of the shard.
+    :param shard: The shard whose recipes to read, see index_faiss().
+    :param shards: The number of shards. Recipe i of the file belongs to shard i % shards.
+    :return: A generator of recipes.
+    """
+    with open(input_file, "r", encoding="utf-8") as f:
+        lines = (line for line in f if line.strip())
+        for line in itertools.islice(lines, shard + skip * shards, None, shards):  # only the shard's are parsed
+            yield json.loads(line)
+
+
+def count_recipes(input_file: str) -> int:
+    """
+    :param input_file: Input .jsonl file containing the recipes.
+    :return: The number of recipes in the file, without parsing them.
+    """
+    with open(input_file, "r", encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def read_checkpoint(output_dir: str, build: dict) -> int:
+    """
+    Find how many recipes an interrupted build of the same input already embedded.
+    :param output_dir: Directory in which the build writes its files.
+    :param build: The input file, recipe count and model of the current build.
+    :return: The number of recipes that were embedded and stored, or 0 if there is no matching checkpoint.
+    """
+    path = os.path.join(output_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r") as f:
+        checkpoint = json.load(f)
+    if any(checkpoint.get(key) != value for key, value in build.items()):
+        print("Ignoring checkpoint of a build with a different input or model.")
+        return 0
+    return checkpoint["done"]
+
+
+def write_checkpoint(output_dir: str, build: dict, done: int) -> None:
+    """
+    Record how many recipes were embedded and stored. Written to a temporary file first, so an interruption
+    never leaves a partial checkpoint behind.
+    :param output_dir: Directory in which the build writes its files.
+    :param build: The input file, recipe count and model of the current build.
+    :param done: The number of recipes that were embedded and stored.
+    """
+    path = os.path.join(output_dir, CHECKPOINT_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({**build, "done": done}, f)
+    os.replace(path + ".tmp", path)
+
+
+def embed_stream(read: callable, output_dir: str, build: dict, batch_size: int = 256, chunk_size: int = 8192,
+                 workers: int = 1, resume: bool = True, total: int = None, shard: int = 0,
+                 shards: int = 1) -> np.ndarray:
+    """
+    Stream recipes into the recipe store, and their normalized embeddings into the embedding file, chunk by chunk.
+    Progress is checkpointed after every chunk, so an interrupted build resumes after the last completed chunk.
+    :param read: A function that takes a number of recipes to skip and returns an iterator of the recipes after them,
+    in the same order on every call.
+    :param output_dir: Directory in which to save the recipe store and embeddings.
+    :param build: What identifies the input of the build, e.g. the input file. A checkpoint is only resumed by a build
+    with the same input and model.
+    :param batch_size: The number of recipes the model encodes at once.
+    :param chunk_size: The number of recipes read, encoded and checkpointed at once.
+    :param workers: The number of processes encoding in parallel.
+    :param resume: Whether to resume an interrupted build of the same input.
+    :param total: The number of recipes, if known in advance, for the progress bar.
+    :param shard: The shard the recipes belong to, see index_faiss().
+    :param shards: The number of shards.
+    :return: The memory-mapped embedding matrix.
+    """
+    model = SentenceTransformer(MODEL_NAME)  # embedding model
+    dim = model.get_sentence_embedding_dimension()
+
+    build = {**build, "model": MODEL_NAME}
+    done = read_checkpoint(output_dir, build) if resume else 0
+    if done:
+        print(f"Resuming after {done} recipes.")
+
+    pool = model.start_multi_process_pool(["cpu"] * workers) if workers > 1 else None
+    start, start_done = time.perf_counter(), done
+
+    try:
+        with open(os.path.join(output_dir, EMBEDDINGS_FILE), "r+b" if done else "wb") as embedding_file, \
+                RecipeStoreWriter(output_dir, keep=done) as store, \
+                tqdm(total=total, initial=done, desc="Embedding recipes", unit="recipe") as progress:
+            embedding_file.truncate(done * dim * 4)  # drop embeddings written after the checkpoint
+            embedding_file.seek(0, os.SEEK_END)
+            recipes = read(done)
+
+            while chunk := list(itertools.islice(recipes, chunk_size)):
+                embedding_file.write(encode_texts(model, [recipe_text(r) for r in chunk], batch_size, pool).tobytes())
+                for recipe in chunk:
+                    store.append(recipe, shard + store.count * shards)  # built recipes get their input position as ID
+
+                embedding_file.flush()
+                store.flush()
+                done += len(chunk)
+                write_checkpoint(output_dir, build, done)
+                progress.update(len(chunk))
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+    if done == 0:
+        raise ValueError("The input contains no recipes.")
+
+    elapsed = time.perf_counter() - start
+    if done > start_done:
+        print(f"Embedded {done - start_done} recipes in {elapsed:.1f}s "
+              f"({(done - start_done) / elapsed:.1f} recipes/s).")
+
+    return load_embeddings(output_dir, dim)
+
+
+def embed_recipes(input_file: str, output_dir: str, batch_size: int = 256, chunk_size: int = 8192,
+                  workers: int = 1, resume: bool = True, shard: int = 0, shards: int = 1) -> np.ndarray:
+    """
+    Stream recipes from the input file into the recipe store and the embedding file, see embed_stream().
+    :param input_file: Input .jsonl file containing the recipes.
+    :param output_dir: Directory in which to save the recipe store and embeddings.
+    :param batch_size: The number of recipes the model encodes at once.
+    :param chunk_size: The number of recipes read, encoded and checkpointed at once.
+    :param workers: The number of processes encoding in parallel.
+    :param resume: Whether to resume an interrupted build of the same input.
+    :param shard: The shard whose recipes to embed, see index_faiss().
+    :param shards: The number of shards.
+    :return: The memory-mapped embedding matrix.
+    """
+    total = len(range(shard, count_recipes(input_file), shards))
+    if total == 0:
+        raise ValueError(f"{input_file} contains no recipes" + (f" for shard {shard}." if shards > 1 else "."))
+
+    build = {"input_file": os.path.abspath(input_file), "total": total}
+    if shards > 1:
+        build.update(shard=shard, shards=shards)
+    return embed_stream(
+        lambda skip: read_recipes(input_file, skip, shard, shards), output_dir, build, batch_size, chunk_size,
+        workers, resume, total, shard, shards
+    )
+
+
+def read_build_inputs(dietary_json: str = None, vocabulary_json: str = None) -> tuple:
+    """
+    Read the inputs of the ingredient index. They are read before embedding, so a missing file doesn't fail the build
+    at the end.
+    :param dietary_json: A .json file with the ingredients excluded by each dietary restriction, which searches can
+    filter by.
+    :param vocabulary_json: A .json file with the canonical ingredient vocabulary written by vocabulary.py, whose
+    ingredient IDs the index uses.
+    :return: The normalized dietary restrictions and the vocabulary, or None without one.
+    """
+    restrictions = {}
+    if dietary_json:
+        with open(dietary_json, "r", encoding="utf-8") as f:
+            restrictions = normalize_restrictions(json.load(f))
+    vocabulary = Vocabulary.load(vocabulary_json) if vocabulary_json else None
+    return restrictions, vocabulary
+
+
+def build_index(output_dir: str, embeddings: np.ndarray, index_type: str = "flat", restrictions: dict = None,
+                vocabulary: Vocabulary = None, shard: int = 0, shards: int = 1, **index_options) -> None:
+    """
+    Create the FAISS index and the ingredient index of the embedded recipes, and report the recall and latency of the
+    FAISS index.
+    :param output_dir: Directory containing the recipe store and embeddings, in which to save the indexes.
+    :param embeddings: The embedding matrix returned by embed_stream().
+    :param index_type: The type of FAISS index to create, see create_index().
+    :param restrictions: The normalized dietary restrictions, see read_build_inputs().
+    :param vocabulary: The canonical ingredient vocabulary, see read_build_inputs().
+    :param shard: The shard the recipes belong to, see index_faiss().
+    :param shards: The number of shards.
+    :param index_options: Parameters of the index type, see create_index().
+    """
+    index, config = create_index(embeddings, index_type, **index_options)  # creating FAISS index
+    config["next_recipe_id"] = shard + len(embeddings) * shards
+    if shards > 1:
+        config.update(shard=shard, shards=shards)  # the IDs of the shard's recipes, see add_recipes()
+    if config["precision"] == "int8":
+        config["embedding_scale"] = embedding_scale(embeddings).tolist()
+
+    report = evaluate_index(index, config, embeddings)  # against the float32 embeddings, before they are replaced
+
+    write_index(index, output_dir)
+
+    # normalized ingredients, so search doesn't re-normalize
+    IngredientIndex.build(RecipeStore(output_dir), restrictions, vocabulary).save(output_dir)
+
+    # a resumed build appends float32 embeddings, so it must not find a checkpoint once they are quantized
+    os.remove(os.path.join(output_dir, CHECKPOINT_FILE))
+    store_embeddings(output_dir, embeddings, config)
+    write_config(output_dir, config)
+
+    print(f"Indexed {index.ntotal} full recipes.")
+    print(f"{index_type}: recall@{report['k']} {report['recall']:.3f}, "
+          f"{report['latency_ms']:.3f} ms/query (flat: {report['flat_latency_ms']:.3f} ms/query)")
+    if "embedding_recall" in report:
+        saved = report["float32_vector_bytes"] - report["embedding_bytes"]
+        print(f"{report['precision']}: embeddings {report['embedding_bytes'] / 2 ** 20:.1f} MB, "
+              f"{saved / 2 ** 20:.1f} MB saved, recall@{report['k']} {report['embedding_recall']:.3f}; "
+              f"index {report['index_bytes'] / 2 ** 20:.1f} MB "
+              f"(float32 vectors: {report['float32_vector_bytes'] / 2 ** 20:.1f} MB)")
+
+    with open(f"{output_dir}/{REPORT_FILE}", "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def write_index(index, output_dir: str) -> None:
+    """
+    Replace the FAISS index file atomically. Search processes may have the old file memory-mapped, and truncating
+    it in place would crash them, while a replaced file stays mapped until they reload.
+    :param index: The FAISS index.
+    :param output_dir: Directory in which to save the index.
+    """
+    path = os.path.join(output_dir, INDEX_FILE)
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def store_embeddings(output_dir: str, embeddings: np.ndarray, config: dict) -> None:
+    """
+    Rewrite the float32 embedding matrix in the precision of the index, for re-ranking at search time.
+    :param output_dir: Directory containing the embedding file.
+    :param embeddings: The float32 embeddings, which may be memory-mapped from the file being replaced.
+    :param config: The index config, with the precision and, for int8, the per-dimension scale.
+    """
+    precision = config["precision"]
+    if precision == "float32":
+        return
+
+    scale = np.array(config["embedding_scale"], dtype=np.float32) if precision == "int8" else None
+    path = os.path.join(output_dir, EMBEDDINGS_FILE)
+    with open(path + ".tmp", "wb") as f:
+        for i in range(0, len(embeddings), ADD_BATCH_SIZE):
+            f.write(quantize_embeddings(np.asarray(embeddings[i:i + ADD_BATCH_SIZE]), precision, scale).tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def index_faiss(input_file: str, output_dir: str, index_type: str = "flat", batch_size: int = 256,
+                chunk_size: int = 8192, workers: int = 1, resume: bool = True, dietary_json: str = None,
+                vocabulary_json: str = None, shards: int = 1, shard: int = None, **index_options) -> None:
     """
     Create FAISS index from input file.
+    With several shards, recipe i of the input file goes to shard i % shards, and every shard is built like an index
+    of its own in a subdirectory of output_dir, with its own FAISS index, embeddings, recipe store and ingredient
+    index. Recipes keep their position in the input as their ID. The shards are listed in SHARDS_FILE once all of
+    them are built, see sharded_search.py for searching them.
     :param input_file: Input .jsonl file containing the recipes.
     :param output_dir: Directory in which to save the FAISS index.
+    :param index_type: The type of FAISS index to create, see create_index().
+    :param batch_size: The number of recipes the model encodes at once.
+    :param chunk_size: The number of recipes read, encoded and checkpointed at once.
+    :param workers: The number of processes encoding in parallel.
+    :param resume: Whether to resume an interrupted build of the same input.
+    :param dietary_json: A .json file with the ingredients excluded by each dietary restriction, which searches can
+    filter by.
+    :param vocabulary_json: A .json file with the canonical ingredient vocabulary written by vocabulary.py, whose
+    ingredient IDs the index uses.
+    :param shards: The number of shards to split the recipes into.
+    :param shard: The only shard to rebuild, e.g. after changing its index options, or None to build every shard.
+    :param index_options: Parameters of the index type, see create_index().
+    """
+    restrictions, vocabulary = read_build_inputs(dietary_json, vocabulary_json)
+    if shards == 1:
+        embeddings = embed_recipes(input_file, output_dir, batch_size, chunk_size, workers, resume)
+        build_index(output_dir, embeddings, index_type, restrictions, vocabulary, **index_options)
+        return
+
+    shard_dirs = [SHARD_DIR.format(i) for i in range(shards)]
+    if shard is not None and os.path.exists(os.path.join(output_dir, SHARDS_FILE)):
+        if read_shards(output_dir) != shard_dirs:
+            raise ValueError(f"{output_dir} has a different number of shards. Rebuild every shard instead.")
+
+    for i in range(shards) if shard is None else [shard]:
+        shard_dir = os.path.join(output_dir, shard_dirs[i])
+        os.makedirs(shard_dir, exist_ok=True)
+        print(f"Building {shard_dirs[i]} of {shards} shards.")
+        embeddings = embed_recipes(input_file, shard_dir, batch_size, chunk_size, workers, resume, i, shards)
+        build_index(shard_dir, embeddings, index_type, restrictions, vocabulary, i, shards, **index_options)
+
+    missing = [name for i, name in enumerate(shard_dirs) if not shard_built(os.path.join(output_dir, name), i, shards)]
+    if missing:  # searches would fail to open the missing shards
+        print(f"{SHARDS_FILE} is written once every shard is built, still missing: {', '.join(missing)}.")
+        return
+    with open(os.path.join(output_dir, SHARDS_FILE), "w") as f:
+        json.dump({"shards": shard_dirs}, f, indent=2)
+
+
+def shard_built(shard_dir: str, shard: int, shards: int) -> bool:
     """
-    recipes = []
+    :param shard_dir: The directory of a shard.
+    :param shard: The number of the shard.
+    :param shards: The number of shards.
+    :return: Whether the directory holds a built index of this shard, out of this number of shards.
+    """
+    config_path = os.path.join(shard_dir, CONFIG_FILE)
+    if not os.path.exists(config_path) or not os.path.exists(os.path.join(shard_dir, INDEX_FILE)):
+        return False
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    return config.get("shard") == shard and config.get("shards") == shards
 
-    with open(input_file, "r", encoding="utf-8") as f:  # load recipes
-        for line in f:
-            recipes.append(json.loads(line))
 
-    texts = [f"{r['title']}: {r['ingredients']}\n{r['directions']}" for r in recipes]  # texts for embedding
+def write_config(output_dir: str, config: dict) -> None:
+    """
+    :param output_dir: Directory containing the FAISS index.
+    :param config: The index config to write.
+    """
+    with open(f"{output_dir}/{CONFIG_FILE}", "w") as f:
+        json.dump(config, f, indent=2)
 
-    model = SentenceTransformer("all-MiniLM-L6-v2")  # embedding model
 
-    batch_size = 8
-    all_embeddings = []
+def index_options(config: dict) -> dict:
+    """
+    :param config: An index config written by create_index().
+    :return: The create_index() parameters that recreate an index of the same type.
+    """
+    names = {"nlist": "nlist", "nprobe": "nprobe", "pq_m": "pq_m", "pq_nbits": "pq_nbits", "hnsw_m": "hnsw_m",
+             "efConstruction": "ef_construction", "efSearch": "ef_search", "precision": "precision"}
+    return {option: config[key] for key, option in names.items() if key in config}
+
 
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i+batch_size]
-        emb = model.encode(batch, batch_size=batch_size, show_progress_bar=False)
-        all_embeddings.extend(emb)
+def add_recipes(input_file: str, output_dir: str, batch_size: int = 256, workers: int = 1) -> None:
+    """
+    Add new recipes to an existing index, embedding only those recipes. A recipe with the "id" of an existing recipe
+    replaces it if it changed: the old version is deleted and the new one keeps the ID. Of recipes with the same "id",
+    only the last one in the file counts. Recipes without an "id" get a new one, after every existing ID and every ID
+    of the file. In a shard, new IDs are those of the shard, and changed recipes must be added to the shard holding
+    them.
+    :param input_file: Input .jsonl file containing the recipes to add.
+    :param output_dir: Directory containing the FAISS index.
+    :param batch_size: The number of recipes the model encodes at once.
+    :param workers: The number of processes encoding in parallel.
+    """
+    with open(f"{output_dir}/{CONFIG_FILE}", "r") as f:
+        config = json.load(f)
+    store = RecipeStore(output_dir)
+    next_id = config.get("next_recipe_id", len(store))
+    shard, shards = config.get("shard", 0), config.get("shards", 1)
 
-    embeddings_np = np.array(all_embeddings).astype("float32")
+    new = {}
+    replaced = []
 
-    index = faiss.IndexFlatL2(embeddings_np.shape[1])  # creating FAISS index
-    index.add(embeddings_np)
+    recipes = list(read_recipes(input_file))
+    last = {recipe["id"]: i for i, recipe in enumerate(recipes) if recipe.get("id") is not None}
+    # new IDs come after every ID of the file, so they never collide with an ID given later in the file
+    next_id = max([next_id] + [recipe_id + 1 for recipe_id in last])
+    next_id += (shard - next_id) % shards  # new IDs of a shard stay apart from those of the other shards
 
-    faiss.write_index(index, f"{output_dir}/recipe_index.faiss")
+    for i, recipe in enumerate(recipes):
+        recipe_id = recipe.get("id")
+        if recipe_id is None:
+            recipe_id = next_id
+            next_id += shards
+        elif last[recipe_id] != i:
+            continue  # a later version in the same file wins
+        else:
+            recipe_idx = store.find(recipe_id)
+            if recipe_idx is not None:
+                if store[recipe_idx] == recipe:
+                    continue  # unchanged
+                replaced.append(recipe_idx)
+        new[recipe_id] = recipe
 
-    with open(f"{output_dir}/recipe_metadata.json", "w") as f:
-        json.dump(recipes, f)
+    if not new:
+        print("No new or changed recipes.")
+        return
 
-    print(f"Indexed {index.ntotal} full recipes.")
+    model = SentenceTransformer(MODEL_NAME)
+    pool = model.start_multi_process_pool(["cpu"] * workers) if workers > 1 else None
+    try:
+        embeddings = encode_texts(model, [recipe_text(r) for r in new.values()], batch_size, pool)
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+    precision = config.get("precision", "float32")
+    scale = np.array(config["embedding_scale"], dtype=np.float32) if "embedding_scale" in config else None
+    with open(f"{output_dir}/{EMBEDDINGS_FILE}", "ab") as f:
+        f.write(quantize_embeddings(embeddings, precision, scale).tobytes())
+
+    with RecipeStoreWriter(output_dir, keep=len(store)) as writer:
+        for recipe_id, recipe in new.items():
+            writer.append(recipe, recipe_id)
+    RecipeStore.delete(output_dir, replaced)
+
+    ingredient_index = IngredientIndex.load(output_dir)
+    ingredient_index.extend(new.values())
+    ingredient_index.save(output_dir)
+
+    index = faiss.read_index(f"{output_dir}/{INDEX_FILE}")
+    index.add(embeddings)  # positions continue after the existing recipes, like the store
+    write_index(index, output_dir)
+
+    config["next_recipe_id"] = next_id
+    write_config(output_dir, config)
+
+    print(f"Added {len(new) - len(replaced)} recipes and updated {len(replaced)} recipes.")
+
+
+def delete_recipes(output_dir: str, recipe_ids: list) -> None:
+    """
+    Delete recipes from an index. They are tombstoned, so searches skip them, until the index is compacted.
+    :param output_dir: Directory containing the FAISS index.
+    :param recipe_ids: The stable IDs of the recipes to delete.
+    """
+    store = RecipeStore(output_dir)
+    recipe_idxs = []
+
+    for recipe_id in recipe_ids:
+        recipe_idx = store.find(recipe_id)
+        if recipe_idx is None:
+            print(f"No recipe with ID {recipe_id}.")
+        else:
+            recipe_idxs.append(recipe_idx)
+
+    RecipeStore.delete(output_dir, recipe_idxs)
+
+    print(f"Deleted {len(recipe_idxs)} recipes.")
+
+
+def compact(output_dir: str) -> None:
+    """
+    Purge deleted recipes from an index. The store, embeddings, ingredient index and FAISS index are rewritten with
+    only the remaining recipes, which keep their IDs, and the FAISS index is rebuilt with the same type and parameters.
+    :param output_dir: Directory containing the FAISS index.
+    """
+    with open(f"{output_dir}/{CONFIG_FILE}", "r") as f:
+        config = json.load(f)
+    store = RecipeStore(output_dir)
+    kept = np.flatnonzero(~store.deleted)
+
+    if len(kept) == len(store):
+        print("No deleted recipes to purge.")
+        return
+
+    tmp_dir = os.path.join(output_dir, "compact.tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    precision, scale = config.get("precision", "float32"), config.get("embedding_scale")
+    embeddings = load_embeddings(output_dir, config["dim"], precision=precision, scale=scale)
+    codes = getattr(embeddings, "codes", embeddings)  # copied as stored, so they are not quantized twice
+    with open(f"{tmp_dir}/{EMBEDDINGS_FILE}", "wb") as f:
+        for i in range(0, len(kept), ADD_BATCH_SIZE):
+            f.write(np.ascontiguousarray(codes[kept[i:i + ADD_BATCH_SIZE]]).tobytes())
+
+    with RecipeStoreWriter(tmp_dir) as writer:
+        for recipe_idx in kept:
+            recipe = store[recipe_idx]
+            writer.append(recipe, recipe["id"])
+
+    ingredient_index = IngredientIndex.load(output_dir)
+    IngredientIndex.build(
+        RecipeStore(tmp_dir), ingredient_index.restrictions, ingredient_index.vocabulary
+    ).save(tmp_dir)
+
+    index, new_config = create_index(
+        load_embeddings(tmp_dir, config["dim"], precision=precision, scale=scale), config["index_type"],
+        **index_options(config)
+    )
+    faiss.write_index(index, f"{tmp_dir}/{INDEX_FILE}")
+    new_config["next_recipe_id"] = config.get("next_recipe_id", len(store))
+    if scale is not None:
+        new_config["embedding_scale"] = scale
+    if "shards" in config:
+        new_config.update(shard=config["shard"], shards=config["shards"])
+    write_config(tmp_dir, new_config)
+
+    purged = len(store) - len(kept)
+    del embeddings, codes, store  # release the mappings of the files being replaced
+    for name in os.listdir(tmp_dir):
+        os.replace(os.path.join(tmp_dir, name), os.path.join(output_dir, name))
+    os.rmdir(tmp_dir)
+
+    print(f"Purged {purged} deleted recipes, {len(kept)} recipes remain.")
+
+
+def add_build_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the options of a build from scratch, shared by faiss_index.py build and pipeline.py.
+    :param parser: The parser of the build command.
+    """
+    parser.add_argument(
+        '--index_type',
+        choices=INDEX_TYPES,
+        default='flat',
+        help='The type of FAISS index: exact search (flat), or approximate search (ivf, ivfpq, hnsw).'
+    )
+    parser.add_argument(
+        '--nlist',
+        type=int,
+        default=None,
+        help='ivf/ivfpq: the number of clusters. Defaults to 4 * sqrt(number of recipes).'
+    )
+    parser.add_argument(
+        '--nprobe',
+        type=int,
+        default=16,
+        help='ivf/ivfpq: the number of clusters visited per search.'
+    )
+    parser.add_argument(
+        '--pq_m',
+        type=int,
+        default=48,
+        help='ivfpq: the number of sub-quantizers, which must divide the embedding dimension.'
+    )
+    parser.add_argument(
+        '--pq_nbits',
+        type=int,
+        default=8,
+        help='ivfpq: the number of bits per sub-quantizer code.'
+    )
+    parser.add_argument(
+        '--hnsw_m',
+        type=int,
+        default=32,
+        help='hnsw: the number of neighbours per node.'
+    )
+    parser.add_argument(
+        '--ef_construction',
+        type=int,
+        default=200,
+        help='hnsw: the size of the candidate list while building.'
+    )
+    parser.add_argument(
+        '--ef_search',
+        type=int,
+        default=64,
+        help='hnsw: the size of the candidate list while searching.'
+    )
+    parser.add_argument(
+        '--precision',
+        choices=list(PRECISIONS),
+        default='float32',
+        help='How the embeddings are stored in the index (except ivfpq) and for re-ranking: float32, float16, or int8 '
+             'with per-dimension scalar quantization.'
+    )
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=8192,
+        help='The number of recipes read, encoded and checkpointed at once.'
+    )
+    parser.add_argument(
+        '--restart',
+        action='store_true',
+        help='A boolean determining whether an interrupted build should be started over instead of resumed.'
+    )
+    parser.add_argument(
+        '--dietary_json',
+        type=str,
+        default='dietary_restriction_exclusion_lists.json',
+        help='A json file containing the ingredients to exclude per dietary restriction.'
+    )
+    parser.add_argument(
+        '--vocabulary_json',
+        type=str,
+        default='ingredient_vocabulary.json',
+        help='A json file containing the canonical ingredient vocabulary written by vocabulary.py.'
+    )
+
+
+def build_options(args: argparse.Namespace) -> dict:
+    """
+    :param args: The parsed options of a build, see add_build_arguments().
+    :return: The index_faiss() keyword arguments of the options.
+    """
+    return {
+        "chunk_size": args.chunk_size,
+        "resume": not args.restart,
+        "dietary_json": args.dietary_json,
+        "vocabulary_json": args.vocabulary_json,
+        "nlist": args.nlist,
+        "nprobe": args.nprobe,
+        "pq_m": args.pq_m,
+        "pq_nbits": args.pq_nbits,
+        "hnsw_m": args.hnsw_m,
+        "ef_construction": args.ef_construction,
+        "ef_search": args.ef_search,
+        "precision": args.precision
+    }
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog='faiss_index.py',
-        description='Create FAISS index.'
+        description='Create or update a FAISS index.'
     )
-    parser.add_argument(
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Create a FAISS index from scratch.')
+    build_parser.add_argument(
         'input_file',
         type=str,
         help='A jsonl file containing the raw recipes.'
     )
-    parser.add_argument(
+    build_parser.add_argument(
         'output_dir',
         type=str,
         help='The directory in which the index and metadata should be written.'
     )
+    add_build_arguments(build_parser)
+    build_parser.add_argument(
+        '--shards',
+        type=int,
+        default=1,
+        help='The number of shards to split the recipes into, each with its own index, searched in parallel.'
+    )
+    build_parser.add_argument(
+        '--shard',
+        type=int,
+        default=None,
+        help='The only shard to build or rebuild, from 0 to shards - 1. Every shard is built by default.'
+    )
+
+    add_parser = subparsers.add_parser('add', help='Add new or changed recipes to an existing FAISS index.')
+    add_parser.add_argument(
+        'input_file',
+        type=str,
+        help='A jsonl file containing the recipes to add. Recipes with the "id" of an existing recipe replace it.'
+    )
+    add_parser.add_argument(
+        'output_dir',
+        type=str,
+        help='The directory containing the index and metadata.'
+    )
+
+    for subparser in (build_parser, add_parser):
+        subparser.add_argument(
+            '--batch_size',
+            type=int,
+            default=256,
+            help='The number of recipes the model encodes at once.'
+        )
+        subparser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='The number of processes encoding in parallel.'
+        )
+
+    delete_parser = subparsers.add_parser('delete', help='Delete recipes from an existing FAISS index.')
+    delete_parser.add_argument(
+        'output_dir',
+        type=str,
+        help='The directory containing the index and metadata.'
+    )
+    delete_parser.add_argument(
+        'recipe_ids',
+        type=int,
+        nargs='+',
+        help='The IDs of the recipes to delete.'
+    )
+
+    compact_parser = subparsers.add_parser('compact', help='Purge deleted recipes from an existing FAISS index.')
+    compact_parser.add_argument(
+        'output_dir',
+        type=str,
+        help='The directory containing the index and metadata.'
+    )
     args = parser.parse_args()
 
-    index_faiss(args.input_file, args.output_dir)
+    if args.command == 'build':
+        index_faiss(
+            args.input_file,
+            args.output_dir,
+            args.index_type,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            shards=args.shards,
+            shard=args.shard,
+            **build_options(args)
+        )
+    elif args.command == 'add':
+        add_recipes(args.input_file, args.output_dir, args.batch_size, args.workers)
+    elif args.command == 'delete':
+        delete_recipes(args.output_dir, args.recipe_ids)
+    elif args.command == 'compact':
+        compact(args.output_dir)
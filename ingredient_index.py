@@ -0,0 +1,316 @@
+import json
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from extract_ingredients import extract_ingredients
+from vocabulary import Vocabulary, VOCABULARY_FILE
+
+VOCAB_FILE = 'ingredient_vocab.json'
+TABLE_FILE = 'recipe_ingredients.npz'
+RESTRICTIONS_FILE = 'dietary_restrictions.json'
+MAX_RESTRICTIONS = 64  # one bit of a uint64 mask per restriction
+
+
+def recipe_ingredient_set(ingredients: str) -> set:
+    """
+    Normalize every line of a recipe's ingredient list.
+    :param ingredients: The newline-separated ingredient lines of a recipe.
+    :return: The set of normalized ingredients.
+    """
+    return set(extract_ingredients(line) for line in ingredients.split('\n') if line.strip())
+
+
+def normalize_restrictions(restrictions: dict) -> dict:
+    """
+    Normalize the excluded ingredients of every dietary restriction like recipe ingredients.
+    :param restrictions: The ingredients excluded by each dietary restriction, by restriction name, e.g. the contents
+    of dietary_restriction_exclusion_lists.json.
+    :return: The normalized ingredients excluded by each dietary restriction.
+    """
+    return {
+        name: sorted(set(extract_ingredients(ingredient) for ingredient in excluded))
+        for name, excluded in restrictions.items()
+    }
+
+
+class IngredientIndex:
+    """
+    The normalized ingredients of every recipe, stored as integer ingredient IDs in CSR form:
+    the IDs of recipe i are ids[offsets[i]:offsets[i + 1]], sorted and without duplicates.
+    The inverted index is stored the same way: the recipes containing ingredient j are
+    posting_ids[posting_offsets[j]:posting_offsets[j + 1]], sorted by recipe position.
+    Dietary restrictions are stored as one uint64 mask per recipe, where bit b is set if the recipe contains an
+    ingredient excluded by restriction b.
+    With a canonical vocabulary, every ingredient name is collapsed to its canonical ingredient before it gets an ID,
+    and the IDs are those of the vocabulary, so recipes, searches and dietary restrictions share them.
+    """
+
+    def __init__(self, vocab: list, offsets: np.ndarray, ids: np.ndarray,
+                 posting_offsets: np.ndarray = None, posting_ids: np.ndarray = None,
+                 restrictions: dict = None, restriction_masks: np.ndarray = None, vocabulary: Vocabulary = None):
+        """
+        :param vocab: The normalized ingredient names, where an ingredient's ID is its position in the list.
+        :param offsets: An array of length (number of recipes + 1) with the start of each recipe in ids.
+        :param ids: The concatenated ingredient IDs of all recipes.
+        :param posting_offsets: An array of length (vocabulary size + 1) with the start of each ingredient in
+        posting_ids. Built from offsets and ids if not given.
+        :param posting_ids: The concatenated recipe positions of all ingredients.
+        :param restrictions: The normalized ingredients excluded by each dietary restriction, by restriction name.
+        :param restriction_masks: The restriction mask of every recipe. Built from restrictions if not given.
+        :param vocabulary: The canonical ingredient vocabulary, or None to keep normalized ingredient names as they
+        are.
+        """
+        self.vocabulary = vocabulary
+        self.vocab = vocab
+        self.vocab_ids = {name: i for i, name in enumerate(vocab)}
+        self.offsets = offsets
+        self.ids = ids
+        self.lengths = np.diff(offsets)
+        self._matrix = None
+
+        if posting_offsets is None or posting_ids is None:
+            posting_offsets, posting_ids = self._invert()
+        self.posting_offsets = posting_offsets
+        self.posting_ids = posting_ids
+
+        self.restrictions = restrictions or {}
+        if len(self.restrictions) > MAX_RESTRICTIONS:
+            raise ValueError(f'At most {MAX_RESTRICTIONS} dietary restrictions are supported, '
+                             f'got {len(self.restrictions)}.')
+        if restriction_masks is None:
+            restriction_masks = self._restriction_masks()
+        self.restriction_masks = restriction_masks
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _invert(self) -> tuple:
+        """
+        Build the ingredient -> recipe posting lists from the recipe -> ingredient table.
+        :return: The posting offsets and the posting recipe positions.
+        """
+        recipe_of_entry = np.repeat(np.arange(len(self), dtype=np.int64), self.lengths)
+        order = np.argsort(self.ids, kind='stable')  # stable, so every posting list stays sorted by recipe
+
+        posting_offsets = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.ids, minlength=len(self.vocab)), out=posting_offsets[1:])
+
+        return posting_offsets, recipe_of_entry[order]
+
+    def _restriction_masks(self) -> np.ndarray:
+        """
+        Mark every recipe with the dietary restrictions it violates, using the posting lists of the excluded
+        ingredients.
+        :return: The restriction mask of every recipe.
+        """
+        masks = np.zeros(len(self), dtype=np.uint64)
+        for bit, excluded in enumerate(self.restrictions.values()):
+            masks[self.postings(self.lookup(excluded))] |= np.uint64(1 << bit)
+        return masks
+
+    def canonical(self, ingredient: str) -> str:
+        """
+        :param ingredient: A normalized ingredient name.
+        :return: Its canonical name, or the name itself without a vocabulary.
+        """
+        if self.vocabulary is None:
+            return ingredient
+        return self.vocabulary.canonical(ingredient)
+
+    @classmethod
+    def build(cls, recipes, restrictions: dict = None, vocabulary: Vocabulary = None) -> 'IngredientIndex':
+        """
+        Normalize the ingredients of every recipe once and assign each distinct ingredient an ID.
+        :param recipes: An iterable of recipes, each with newline-separated ingredient lines.
+        :param restrictions: The normalized ingredients excluded by each dietary restriction, by restriction name,
+        see normalize_restrictions().
+        :param vocabulary: The canonical ingredient vocabulary, whose IDs the index uses. Ingredients missing from it
+        get IDs after its own.
+        :return: The ingredient index.
+        """
+        vocab = list(vocabulary.ingredients) if vocabulary is not None else []
+        ingredient_index = cls(vocab=vocab, offsets=np.zeros(1, dtype=np.int64), ids=np.empty(0, dtype=np.int32),
+                               restrictions=restrictions, vocabulary=vocabulary)
+        ingredient_index.extend(recipes)
+        return ingredient_index
+
+    def extend(self, recipes) -> None:
+        """
+        Append the ingredients of new recipes, which follow the existing ones in position order. Ingredients that
+        are not in the vocabulary yet get new IDs, so existing IDs stay valid, and the restriction masks are rebuilt,
+        since excluded ingredients may only now be in the vocabulary.
+        :param recipes: An iterable of recipes, each with newline-separated ingredient lines.
+        """
+        offsets = []
+        ids = []
+
+        for recipe in recipes:
+            recipe_ids = set(
+                self.vocab_ids.setdefault(self.canonical(ingredient), len(self.vocab_ids))
+                for ingredient in sorted(recipe_ingredient_set(recipe['ingredients']))  # deterministic IDs
+            )
+            ids.extend(sorted(recipe_ids))
+            offsets.append(len(ids))
+
+        self.vocab = list(self.vocab_ids)
+        self.offsets = np.concatenate([self.offsets, np.array(offsets, dtype=np.int64) + self.offsets[-1]])
+        self.ids = np.concatenate([self.ids, np.array(ids, dtype=np.int32)])
+        self.lengths = np.diff(self.offsets)
+        self._matrix = None
+        self.posting_offsets, self.posting_ids = self._invert()
+        self.restriction_masks = self._restriction_masks()
+
+    def save(self, output_dir: str) -> None:
+        """
+        Save the ingredient vocabulary, the canonical vocabulary if any, the dietary restrictions and the per-recipe
+        ingredient IDs and restriction masks.
+        :param output_dir: Directory in which to save the files.
+        """
+        with open(os.path.join(output_dir, VOCAB_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.vocab, f, ensure_ascii=False)
+
+        if self.vocabulary is not None:
+            self.vocabulary.save(os.path.join(output_dir, VOCABULARY_FILE))
+
+        with open(os.path.join(output_dir, RESTRICTIONS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.restrictions, f, ensure_ascii=False, indent=2)
+
+        np.savez(
+            os.path.join(output_dir, TABLE_FILE),
+            offsets=self.offsets,
+            ids=self.ids,
+            posting_offsets=self.posting_offsets,
+            posting_ids=self.posting_ids,
+            restriction_masks=self.restriction_masks
+        )
+
+    @classmethod
+    def load(cls, input_dir: str) -> 'IngredientIndex':
+        """
+        Load an ingredient index saved with save(). Indexes saved before dietary restrictions or the canonical
+        vocabulary were indexed have none.
+        :param input_dir: Directory containing the files.
+        :return: The ingredient index.
+        """
+        with open(os.path.join(input_dir, VOCAB_FILE), 'r', encoding='utf-8') as f:
+            vocab = json.load(f)
+
+        restrictions = {}
+        restrictions_path = os.path.join(input_dir, RESTRICTIONS_FILE)
+        if os.path.exists(restrictions_path):
+            with open(restrictions_path, 'r', encoding='utf-8') as f:
+                restrictions = json.load(f)
+
+        vocabulary = None
+        vocabulary_path = os.path.join(input_dir, VOCABULARY_FILE)
+        if os.path.exists(vocabulary_path):
+            vocabulary = Vocabulary.load(vocabulary_path)
+
+        with np.load(os.path.join(input_dir, TABLE_FILE)) as tables:
+            return cls(
+                vocab=vocab,
+                offsets=tables['offsets'],
+                ids=tables['ids'],
+                posting_offsets=tables['posting_offsets'],
+                posting_ids=tables['posting_ids'],
+                restrictions=restrictions,
+                restriction_masks=tables['restriction_masks'] if 'restriction_masks' in tables else None,
+                vocabulary=vocabulary
+            )
+
+    def recipe_ids(self, recipe_idx: int) -> np.ndarray:
+        """
+        :param recipe_idx: The position of the recipe in the metadata.
+        :return: The ingredient IDs of the recipe.
+        """
+        return self.ids[self.offsets[recipe_idx]:self.offsets[recipe_idx + 1]]
+
+    def lookup(self, ingredients) -> np.ndarray:
+        """
+        Convert normalized ingredient names to ingredient IDs, through their canonical names. Unknown ingredients are
+        skipped, since no recipe contains them.
+        :param ingredients: An iterable of normalized ingredient names.
+        :return: The distinct ingredient IDs.
+        """
+        names = (self.canonical(i) for i in ingredients)
+        ids = [self.vocab_ids[name] for name in names if name in self.vocab_ids]
+        return np.unique(np.array(ids, dtype=np.int64))
+
+    def postings(self, ingredient_ids: np.ndarray) -> np.ndarray:
+        """
+        :param ingredient_ids: The ingredient IDs whose posting lists should be retrieved.
+        :return: The concatenated posting lists, with one entry per (ingredient, recipe) pair.
+        """
+        if len(ingredient_ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([
+            self.posting_ids[self.posting_offsets[i]:self.posting_offsets[i + 1]] for i in ingredient_ids
+        ])
+
+    @property
+    def matrix(self) -> csr_matrix:
+        """
+        :return: The recipe x ingredient matrix, with a 1 where a recipe contains an ingredient. It shares the offsets
+        and IDs of the index, which are already in CSR form.
+        """
+        if self._matrix is None:
+            self._matrix = csr_matrix(
+                (np.ones(len(self.ids), dtype=np.float32), self.ids, self.offsets), shape=(len(self), len(self.vocab))
+            )
+        return self._matrix
+
+    def coverage(self, user_ids: np.ndarray) -> np.ndarray:
+        """
+        Count how many of the user's ingredients every recipe contains, with one sparse matrix-vector product.
+        :param user_ids: The ingredient IDs of the user's search ingredients.
+        :return: The number of covered ingredients of every recipe.
+        """
+        pantry = np.zeros(len(self.vocab), dtype=np.float32)
+        pantry[user_ids] = 1
+        return self.matrix @ pantry
+
+    def candidates(self, user_ids: np.ndarray, avoid_ids: np.ndarray, mode: str = 'inclusive',
+                   restrictions=(), max_missing: int = None) -> np.ndarray:
+        """
+        Find every recipe that passes the ingredient filter of a search.
+        Inclusive and coverage: the recipe contains at least one of the user's ingredients.
+        Exclusive: every ingredient of the recipe is one of the user's ingredients.
+        In all modes, the recipe contains none of the avoided ingredients, violates none of the restrictions and
+        has at most max_missing ingredients that are not the user's.
+        :param user_ids: The ingredient IDs of the user's search ingredients.
+        :param avoid_ids: The ingredient IDs of the ingredients to avoid.
+        :param mode: Selection type, inclusive, exclusive or coverage.
+        :param restrictions: The names of the dietary restrictions the recipes must comply with.
+        :param max_missing: The maximum number of ingredients of the recipe that are not the user's, or None for no
+        limit.
+        :return: A boolean array with one entry per recipe.
+        """
+        selected = np.zeros(len(self), dtype=bool)
+
+        if mode in ('inclusive', 'coverage'):
+            selected[self.postings(user_ids)] = True
+
+        elif mode == 'exclusive':
+            matches = np.bincount(self.postings(user_ids), minlength=len(self))
+            selected = matches == self.lengths
+
+        selected[self.postings(avoid_ids)] = False
+        if restrictions:
+            selected &= (self.restriction_masks & self.restriction_bits(restrictions)) == 0
+        if max_missing is not None:
+            selected &= self.lengths - self.coverage(user_ids) <= max_missing
+
+        return selected
+
+    def restriction_bits(self, restrictions) -> np.uint64:
+        """
+        :param restrictions: The names of dietary restrictions.
+        :return: The mask with the bits of the restrictions set.
+        """
+        names = list(self.restrictions)
+        bits = 0
+        for restriction in restrictions:
+            if restriction not in self.restrictions:
+                raise ValueError(f'Unknown dietary restriction {restriction!r}, expected one of {names}.')
+            bits |= 1 << names.index(restriction)
+        return np.uint64(bits)
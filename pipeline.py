@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+from contextlib import ExitStack
+from cleanup import is_edible
+from faiss_index import embed_stream, read_build_inputs, build_index, add_build_arguments, build_options
+from preprocess import read_dataset, CHUNK_SIZE
+
+RAW_DUMP_FILE = "recipes.jsonl"
+CLEAN_DUMP_FILE = "clean_recipes.jsonl"
+
+
+def pipeline_recipes(input_csv: str, limit: int = None, sample: float = None, seed: int = 0,
+                     chunk_size: int = CHUNK_SIZE, dump_dir: str = None, skip: int = 0):
+    """
+    Stream recipes from the raw dataset through preprocessing and the inedible-recipe filters, without writing
+    intermediate files.
+    :param input_csv: The .csv file containing the raw dataset.
+    :param limit: The maximum number of recipes read from the dataset, or None for all of them.
+    :param sample: The fraction of recipes to sample at random, or None to keep every recipe.
+    :param seed: The seed of the random sample.
+    :param chunk_size: The number of rows read from the .csv file at once.
+    :param dump_dir: A directory in which to also write the output of every stage, as preprocess.py and cleanup.py
+    would, or None to write nothing.
+    :param skip: The number of edible recipes to skip, e.g. because an interrupted build already embedded them.
+    They are still written to the dumps.
+    :return: A generator of the edible recipes after the skipped ones.
+    """
+    with ExitStack() as stack:
+        raw_dump = clean_dump = None
+        if dump_dir:
+            os.makedirs(dump_dir, exist_ok=True)
+            raw_dump = stack.enter_context(open(os.path.join(dump_dir, RAW_DUMP_FILE), "w", encoding="utf-8"))
+            clean_dump = stack.enter_context(open(os.path.join(dump_dir, CLEAN_DUMP_FILE), "w", encoding="utf-8"))
+
+        for recipe in read_dataset(input_csv, limit, sample, seed, chunk_size):
+            if raw_dump:
+                raw_dump.write(json.dumps(recipe) + "\n")
+            if not is_edible(recipe):
+                continue
+            if clean_dump:
+                clean_dump.write(json.dumps(recipe) + "\n")
+
+            if skip:
+                skip -= 1
+                continue
+            yield recipe
+
+
+def run_pipeline(input_csv: str, output_dir: str, limit: int = None, sample: float = None, seed: int = 0,
+                 index_type: str = "flat", batch_size: int = 256, chunk_size: int = 8192, workers: int = 1,
+                 resume: bool = True, dump_dir: str = None, dietary_json: str = None, vocabulary_json: str = None,
+                 **index_options) -> None:
+    """
+    Build the search files straight from the raw dataset in one bounded-memory job: recipes are read from the .csv
+    file, preprocessed, filtered and embedded chunk by chunk, then indexed like faiss_index.py build does. Since
+    the stream is the same on every run, an interrupted build resumes after its last checkpoint.
+    :param input_csv: The .csv file containing the raw dataset.
+    :param output_dir: Directory in which to save the search files.
+    :param limit: The maximum number of recipes read from the dataset, or None for all of them.
+    :param sample: The fraction of recipes to sample at random, or None to keep every recipe.
+    :param seed: The seed of the random sample.
+    :param index_type: The type of FAISS index to create, see faiss_index.create_index().
+    :param batch_size: The number of recipes the model encodes at once.
+    :param chunk_size: The number of recipes read, encoded and checkpointed at once.
+    :param workers: The number of processes encoding in parallel.
+    :param resume: Whether to resume an interrupted build of the same input.
+    :param dump_dir: A directory in which to also write the output of every stage, or None to write nothing.
+    :param dietary_json: A .json file with the ingredients excluded by each dietary restriction.
+    :param vocabulary_json: A .json file with the canonical ingredient vocabulary written by vocabulary.py.
+    :param index_options: Parameters of the index type, see faiss_index.create_index().
+    """
+    restrictions, vocabulary = read_build_inputs(dietary_json, vocabulary_json)
+
+    build = {"input_file": os.path.abspath(input_csv), "limit": limit, "sample": sample, "seed": seed}
+    embeddings = embed_stream(
+        lambda skip: pipeline_recipes(input_csv, limit, sample, seed, dump_dir=dump_dir, skip=skip),
+        output_dir, build, batch_size, chunk_size, workers, resume, total=limit
+    )
+    build_index(output_dir, embeddings, index_type, restrictions, vocabulary, **index_options)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='pipeline.py',
+        description='Build the search files from the raw dataset in one pass: preprocess, clean up, embed and index.'
+    )
+    parser.add_argument(
+        'input_csv',
+        type=str,
+        help='The .csv file containing the raw dataset.'
+    )
+    parser.add_argument(
+        'output_dir',
+        type=str,
+        help='The directory in which the index and metadata should be written.'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='The maximum number of recipes to read from the dataset, e.g. 50000. All of them by default.'
+    )
+    parser.add_argument(
+        '--sample',
+        type=float,
+        default=None,
+        help='The fraction of recipes to sample at random instead of taking the first ones.'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The seed of the random sample.'
+    )
+    parser.add_argument(
+        '--dump_dir',
+        type=str,
+        default=None,
+        help=f'A directory in which to also write the preprocessed ({RAW_DUMP_FILE}) and cleaned ({CLEAN_DUMP_FILE}) '
+             f'recipes.'
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=256,
+        help='The number of recipes the model encodes at once.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='The number of processes encoding in parallel.'
+    )
+    add_build_arguments(parser)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    run_pipeline(
+        args.input_csv,
+        args.output_dir,
+        args.limit,
+        args.sample,
+        args.seed,
+        args.index_type,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        dump_dir=args.dump_dir,
+        **build_options(args)
+    )
@@ -1,43 +1,110 @@
-import pandas as pd
-import ast
-import os
+import argparse
 import json
+import os
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
+from extract_dataset import parse_list_column
 
-df_full = pd.read_csv("archive/RecipeNLG_dataset.csv")  # load full dataset
-
-df = df_full.iloc[:50000].copy()  # first 50k entries
-os.makedirs("processed", exist_ok=True)
-df.to_csv("processed/RecipeNLG_50k.csv", index=False)
+CHUNK_SIZE = 10000  # rows read from the .csv file at once
 
 
-def clean_list_column(col):
+def format_recipe(title: str, measurements: list, directions: list) -> dict:
     """
-    Cleans stringified lists
+    Format a recipe of the dataset for search.
+    :param title: The title of the recipe.
+    :param measurements: The measurements of the recipe.
+    :param directions: The direction sentences of the recipe.
+    :return: The recipe, with its measurements as a bulleted list and its directions as a numbered list.
     """
-    return ast.literal_eval(col)
-
-
-df = pd.read_csv("processed/RecipeNLG_50k.csv")
-
-df['ingredients'] = df['ingredients'].apply(clean_list_column)
-df['directions'] = df['directions'].apply(clean_list_column)
-
-recipes = []
-for _, row in tqdm(df.iterrows(), total=len(df)):
-    title = row['title']
     # Use full ingredients with measurements
-    ingredients = "\n".join(f"- {ing}" for ing in row['ingredients'])
-    numbered_directions = [f"{i+1}. {sentence}" for i, sentence in enumerate(row['directions'])]
+    ingredients = "\n".join(f"- {ing}" for ing in measurements)
+    numbered_directions = [f"{i+1}. {sentence}" for i, sentence in enumerate(directions)]
     directions = "\n".join(numbered_directions)
-    recipes.append({
+    return {
         "title": title,
         "ingredients": ingredients,
         "directions": directions
-    })
+    }
+
+
+def read_dataset(input_csv: str, limit: int = None, sample: float = None, seed: int = 0,
+                 chunk_size: int = CHUNK_SIZE):
+    """
+    Stream recipes from the raw dataset, chunk by chunk, without loading the whole .csv file.
+    :param input_csv: The .csv file containing the raw dataset.
+    :param limit: The maximum number of recipes, or None for all of them.
+    :param sample: The fraction of recipes to keep at random, or None to keep every recipe.
+    :param seed: The seed of the random sample, so the same recipes are sampled on every run.
+    :param chunk_size: The number of rows read at once.
+    :return: A generator of formatted recipes, see format_recipe().
+    """
+    rng = np.random.default_rng(seed)
+    count = 0
+
+    # without sampling, only the first limit rows need to be read
+    nrows = limit if sample is None else None
+    for chunk in pd.read_csv(input_csv, usecols=['title', 'ingredients', 'directions'], chunksize=chunk_size,
+                             nrows=nrows):
+        if sample is not None:
+            chunk = chunk[rng.random(len(chunk)) < sample]
+
+        titles = chunk['title'].fillna('').tolist()  # a missing title would be written as NaN, which isn't JSON
+        measurements = parse_list_column(chunk['ingredients'])
+        directions = parse_list_column(chunk['directions'])
+
+        for recipe in zip(titles, measurements, directions):
+            if limit is not None and count >= limit:
+                return
+            yield format_recipe(*recipe)
+            count += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='preprocess.py',
+        description='Extract the recipe title, measurements, and directions for a subset of the dataset.'
+    )
+    parser.add_argument(
+        'input_csv',
+        type=str,
+        nargs='?',
+        default='archive/RecipeNLG_dataset.csv',
+        help='The .csv file containing the raw dataset.'
+    )
+    parser.add_argument(
+        'output_jsonl',
+        type=str,
+        nargs='?',
+        default='processed/recipes_50k.jsonl',
+        help='The .jsonl file in which the recipes should be written.'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=50000,
+        help='The maximum number of recipes to extract.'
+    )
+    parser.add_argument(
+        '--sample',
+        type=float,
+        default=None,
+        help='The fraction of recipes to sample at random instead of taking the first ones.'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The seed of the random sample.'
+    )
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.output_jsonl) or '.', exist_ok=True)
+    recipe_count = 0
 
-with open("processed/recipes_50k.jsonl", "w") as f:
-    for recipe in recipes:
-        f.write(json.dumps(recipe) + "\n")
+    with open(args.output_jsonl, "w") as f:
+        for recipe in tqdm(read_dataset(args.input_csv, args.limit, args.sample, args.seed), total=args.limit):
+            f.write(json.dumps(recipe) + "\n")
+            recipe_count += 1
 
-print(f"Created {len(recipes)} recipes with full ingredients.")
+    print(f"Created {recipe_count} recipes with full ingredients.")
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import numpy as np
+from cachetools import TTLCache
+
+
+class QueryCache:
+    """
+    A thread-safe, bounded cache that evicts the least recently used entry when full and drops entries older than
+    its time to live. Hits and misses are counted.
+    Every clear() starts a new generation, so values computed before it can be kept out, see put().
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        :param maxsize: The maximum number of entries.
+        :param ttl: The number of seconds an entry stays valid.
+        """
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._cache)
+
+    def get(self, key):
+        """
+        :param key: The key of the entry.
+        :return: The cached value, or None on a miss.
+        """
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value, generation: int = None) -> None:
+        """
+        :param key: The key of the entry.
+        :param value: The value to cache.
+        :param generation: The generation in which the value was computed, or None for the current one. The value is
+        not cached if the cache was cleared since.
+        """
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self._cache[key] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.generation += 1
+
+    def stats(self) -> dict:
+        """
+        :return: The number of hits, misses and cached entries.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+class EmbeddingCache(QueryCache):
+    """
+    Caches query embeddings by query text. Optionally, embeddings are also written to a SQLite database, so they
+    survive restarts: texts missing from memory are looked up there before they count as misses.
+    """
+
+    def __init__(self, model_name: str, maxsize: int, ttl: float, path: str = None):
+        """
+        :param model_name: The name of the model the embeddings are encoded with. Embeddings of other models stored
+        in the same database are ignored.
+        :param maxsize: The maximum number of embeddings kept in memory.
+        :param ttl: The number of seconds an embedding stays in memory.
+        :param path: The SQLite database to persist embeddings to, or None to only cache in memory.
+        """
+        super().__init__(maxsize, ttl)
+        self.model_name = model_name
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(model TEXT, text TEXT, embedding BLOB, PRIMARY KEY (model, text))"
+            )
+            self._db.commit()
+
+    def get(self, text: str):
+        with self._lock:
+            embedding = self._cache.get(text)
+            if embedding is None and self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding FROM embeddings WHERE model = ? AND text = ?", (self.model_name, text)
+                ).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype="float32")
+                    self._cache[text] = embedding
+
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return embedding
+
+    def put(self, text: str, embedding: np.ndarray) -> None:
+        with self._lock:
+            self._cache[text] = embedding
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (self.model_name, text, embedding.astype("float32").tobytes())
+                )
+                self._db.commit()
@@ -0,0 +1,172 @@
+import json
+import os
+import numpy as np
+
+RECIPES_FILE = 'recipes.bin'
+OFFSETS_FILE = 'recipe_offsets.bin'
+IDS_FILE = 'recipe_ids.bin'
+TOMBSTONES_FILE = 'recipe_tombstones.bin'
+STORE_FILES = [RECIPES_FILE, OFFSETS_FILE, IDS_FILE, TOMBSTONES_FILE]
+
+
+def map_array(path: str, dtype: str) -> np.ndarray:
+    """
+    Memory-map a file of raw values read-only. The pages are backed by the OS page cache, so every process mapping
+    the same file shares one physical copy.
+    :param path: The file to map.
+    :param dtype: The type of the values in the file.
+    :return: The mapped array.
+    """
+    if os.path.getsize(path) == 0:  # np.memmap cannot map empty files
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class RecipeStore:
+    """
+    Read-only recipe metadata on disk. Every recipe is stored as a UTF-8 encoded JSON record in recipes.bin, and
+    recipe i occupies bytes offsets[i]:offsets[i + 1] of it, where offsets are the int64 values in recipe_offsets.bin.
+    Each recipe also has a stable recipe ID in recipe_ids.bin, which survives updates and compaction while its position
+    does not, and a tombstone byte in recipe_tombstones.bin that marks deleted recipes.
+    All files are memory-mapped, so opening the store takes constant time and only the recipes that are accessed
+    get decoded.
+    """
+
+    def __init__(self, directory: str):
+        """
+        :param directory: The directory containing the store files.
+        """
+        self.data = map_array(os.path.join(directory, RECIPES_FILE), 'uint8')
+        self.offsets = map_array(os.path.join(directory, OFFSETS_FILE), 'int64')
+        self.ids = map_array(os.path.join(directory, IDS_FILE), 'int64')
+        self.tombstones = map_array(os.path.join(directory, TOMBSTONES_FILE), 'uint8')
+        self._sorted_ids = None
+        self._id_order = None
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, recipe_idx: int) -> dict:
+        """
+        :param recipe_idx: The position of the recipe in the store, which is also its position in the FAISS index.
+        :return: The decoded recipe, with its stable recipe ID under 'id'.
+        """
+        if not 0 <= recipe_idx < len(self):
+            raise IndexError(f'Recipe {recipe_idx} is out of range for a store of {len(self)} recipes.')
+        recipe = json.loads(self.data[self.offsets[recipe_idx]:self.offsets[recipe_idx + 1]].tobytes())
+        recipe['id'] = int(self.ids[recipe_idx])
+        return recipe
+
+    def __iter__(self):
+        for recipe_idx in range(len(self)):
+            yield self[recipe_idx]
+
+    @property
+    def deleted(self) -> np.ndarray:
+        """
+        :return: A boolean array with one entry per recipe position, True for deleted recipes.
+        """
+        return self.tombstones.astype(bool)
+
+    def find(self, recipe_id: int):
+        """
+        Find the position of a recipe that has not been deleted.
+        :param recipe_id: The stable ID of the recipe.
+        :return: The position of the recipe, or None if there is no such recipe.
+        """
+        if self._sorted_ids is None:
+            self._id_order = np.argsort(self.ids, kind='stable')
+            self._sorted_ids = self.ids[self._id_order]
+
+        # an updated recipe keeps its ID, so only the newest (last) position with the ID can be live
+        pos = np.searchsorted(self._sorted_ids, recipe_id, side='right') - 1
+        if pos >= 0 and self._sorted_ids[pos] == recipe_id:
+            recipe_idx = int(self._id_order[pos])
+            if not self.tombstones[recipe_idx]:
+                return recipe_idx
+        return None
+
+    @staticmethod
+    def write(recipes, output_dir: str) -> int:
+        """
+        Write recipes to a new store, one at a time. Recipes get their position as their ID.
+        :param recipes: An iterable of recipes.
+        :param output_dir: The directory in which the store files should be written.
+        :return: The number of recipes written.
+        """
+        with RecipeStoreWriter(output_dir) as writer:
+            for recipe in recipes:
+                writer.append(recipe, writer.count)
+            return writer.count
+
+    @staticmethod
+    def delete(directory: str, recipe_idxs) -> None:
+        """
+        Mark recipes as deleted. Their data stays in the store until it is compacted.
+        :param directory: The directory containing the store files.
+        :param recipe_idxs: The positions of the recipes to delete.
+        """
+        tombstones = np.memmap(os.path.join(directory, TOMBSTONES_FILE), dtype='uint8', mode='r+')
+        tombstones[np.asarray(recipe_idxs, dtype=np.int64)] = 1
+        tombstones.flush()
+
+
+class RecipeStoreWriter:
+    """
+    Appends recipes to the store files in a directory, creating them if needed.
+    """
+
+    def __init__(self, output_dir: str, keep: int = 0):
+        """
+        :param output_dir: The directory containing the store files.
+        :param keep: The number of recipes already in the store to keep. Any recipes after them, e.g. those written
+        after the last checkpoint of an interrupted build, are discarded. With 0, a new store is created.
+        """
+        paths = [os.path.join(output_dir, name) for name in STORE_FILES]
+
+        if keep:
+            offsets = np.fromfile(paths[1], dtype=np.int64, count=keep + 1)
+            if len(offsets) != keep + 1:
+                raise ValueError(f'Cannot keep {keep} recipes of a store with {len(offsets) - 1} recipes.')
+            self.end = int(offsets[-1])
+            sizes = [self.end, (keep + 1) * 8, keep * 8, keep]
+            self.files = [open(path, 'r+b') for path in paths]
+            for f, size in zip(self.files, sizes):
+                f.truncate(size)
+                f.seek(size)
+        else:
+            self.end = 0
+            self.files = [open(path, 'wb') for path in paths]
+            self.files[1].write(np.int64(0).tobytes())
+
+        self.data_file, self.offsets_file, self.ids_file, self.tombstones_file = self.files
+        self.count = keep
+
+    def append(self, recipe: dict, recipe_id: int) -> int:
+        """
+        :param recipe: The recipe to append. An 'id' key is not stored in the record, since IDs are stored separately.
+        :param recipe_id: The stable ID of the recipe.
+        :return: The position of the recipe in the store.
+        """
+        record = json.dumps({k: v for k, v in recipe.items() if k != 'id'}, ensure_ascii=False).encode('utf-8')
+        self.data_file.write(record)
+        self.end += len(record)
+        self.offsets_file.write(np.int64(self.end).tobytes())
+        self.ids_file.write(np.int64(recipe_id).tobytes())
+        self.tombstones_file.write(b'\0')
+        self.count += 1
+        return self.count - 1
+
+    def flush(self) -> None:
+        for f in self.files:
+            f.flush()
+
+    def close(self) -> None:
+        for f in self.files:
+            f.close()
+
+    def __enter__(self) -> 'RecipeStoreWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -1,13 +1,45 @@
+import argparse
 import json
+import os
+import threading
+import time
+import warnings
+from collections import namedtuple
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import extract_ingredients
+from ingredient_index import IngredientIndex, VOCAB_FILE, TABLE_FILE, RESTRICTIONS_FILE
+from vocabulary import VOCABULARY_FILE
+from recipe_store import RecipeStore, STORE_FILES, map_array
+from query_cache import QueryCache, EmbeddingCache
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
-index = faiss.read_index("processed/recipe_index.faiss")
-with open("processed/recipe_metadata.json", "r") as f:
-    recipes = json.load(f)
+MODEL_NAME = "all-MiniLM-L6-v2"
+INDEX_FILE = "recipe_index.faiss"
+CONFIG_FILE = "index_config.json"
+EMBEDDINGS_FILE = "recipe_embeddings.bin"
+KEYWORD_CANDIDATES = 200  # filtered recipes that are re-ranked by keyword similarity
+EXPANSION_FACTOR = 4  # how much nprobe/efSearch grow per round when a search finds too few filtered recipes
+MAX_EXPANSION = 64  # the most nprobe/efSearch are multiplied by before a search gives up
+RESULT_CACHE_SIZE = 1024
+EMBEDDING_CACHE_SIZE = 4096
+CACHE_TTL = 3600  # seconds
+COVERAGE_CANDIDATES = 1000  # best-covered recipes that are re-ranked by coverage blended with similarity
+COVERAGE_WEIGHT = 0.7
+SearchKey = namedtuple("SearchKey", [
+    "user_names", "mode", "avoid_names", "user_keywords", "top_k", "restrictions", "max_expansion", "max_missing",
+    "coverage_weight"
+])
+# the candidate recipes of a search: their pool scores decide which of them are re-ranked by their final scores
+Ranking = namedtuple("Ranking", ["positions", "pool_scores", "scores"])
+METRICS = {"l2": faiss.METRIC_L2, "inner_product": faiss.METRIC_INNER_PRODUCT}
+PRECISIONS = {"float32": "float32", "float16": "float16", "int8": "int8"}  # stored dtype of each embedding precision
+# IVF indexes memory-map their inverted lists, other indexes their vectors and graph (IO_FLAG_MMAP_IFC, FAISS 1.10+)
+MMAP_FLAGS = {
+    "ivf": faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+    "ivfpq": faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+    "flat": getattr(faiss, "IO_FLAG_MMAP_IFC", None),
+    "hnsw": getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+}
 
 
 def normalize_ingredient(ingredient: str) -> str:
@@ -20,66 +52,659 @@ def normalize_ingredient(ingredient: str) -> str:
     return ingredient
 
 
-def search_faiss_and_filter(model, index, recipes, user_ingredients, avoid_ingredients, user_keywords,
-                            mode="inclusive", top_k=10):
+def search_parameters(config: dict, selector=None) -> faiss.SearchParameters:
     """
-    Retrieves search results given the user's search parameters.
-    :param model: Embedding model
-    :param index: FAISS index
-    :param recipes: Recipe metadata
-    :param user_ingredients: List of the user's search ingredients
-    :param avoid_ingredients: List of ingredients the user would like to avoid
-    :param user_keywords: Additional search keywords that the user can optionally add
-    :param mode: Selection type, inclusive or exclusive
-    :param top_k: The number of results to retrieve
-    :return: The filtered search results
+    Build the search-time parameters of an index from its config, e.g. nprobe for IVF and efSearch for HNSW indexes.
+    :param config: The index config written by faiss_index.py.
+    :param selector: An optional faiss.IDSelector restricting which recipes can be returned.
+    :return: The search parameters.
     """
-    ingredient_query = ", ".join(user_ingredients)
-    ingredient_embedding = model.encode(
-        [ingredient_query], normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
-    )[0].astype("float32")
+    if "nprobe" in config:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=config["nprobe"])
+    if "efSearch" in config:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=config["efSearch"])
+    return faiss.SearchParameters(sel=selector)
 
-    distances, indices = index.search(np.array([ingredient_embedding]), 1000)
 
-    if user_keywords:
-        keyword_emb = model.encode(
-            [user_keywords], normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False
-        )[0].astype("float32")
+def expand_parameters(config: dict, growth: int) -> dict:
+    """
+    Widen the search of an approximate index by visiting more IVF clusters or HNSW neighbours.
+    :param config: The index config written by faiss_index.py.
+    :param growth: The factor to multiply nprobe or efSearch by.
+    :return: A copy of the config with the expanded search-time parameters.
+    """
+    config = dict(config)
+    if "nprobe" in config:
+        config["nprobe"] = min(config["nprobe"] * growth, config.get("nlist", config["nprobe"] * growth))
+    if "efSearch" in config:
+        config["efSearch"] = config["efSearch"] * growth
+    return config
+
+
+def expanding_search(index, config: dict, queries: np.ndarray, candidates: np.ndarray, k: int,
+                     max_expansion: int = MAX_EXPANSION) -> list:
+    """
+    Search among the candidate recipes only, widening the search until it finds k of them.
+    An approximate index only looks at the recipes in the clusters or neighbourhoods it visits, so with a strict
+    filter it can find fewer than k candidates although more exist. The queries that came up short are then searched
+    again with nprobe or efSearch multiplied by EXPANSION_FACTOR until k candidates are found, or the parameters were
+    multiplied by max_expansion or cannot grow further. Exact (flat) indexes always find min(k, number of candidates)
+    in one search.
+    :param index: The FAISS index.
+    :param config: The index config written by faiss_index.py.
+    :param queries: The query embeddings, of shape (number of queries, dim), which share the candidates and k.
+    :param candidates: A boolean array with one entry per recipe, True for the recipes that may be returned.
+    :param k: The number of recipes to find per query.
+    :param max_expansion: The largest factor the search-time parameters are multiplied by.
+    :return: For every query, the positions of the recipes found, best first, and their scores, which are
+    similarities, or negated distances for L2 indexes, so higher is better either way.
+    """
+    k = min(k, int(candidates.sum()))  # no search can find more recipes than there are candidates
+    if k == 0:
+        return [np.empty(0, dtype=np.int64) for _ in queries], [np.empty(0, dtype=np.float32) for _ in queries]
+
+    bitmap = np.packbits(candidates, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(candidates), faiss.swig_ptr(bitmap))
+
+    found = [None] * len(queries)
+    scores = [None] * len(queries)
+    sign = -1 if index.metric_type == faiss.METRIC_L2 else 1
+    remaining = np.arange(len(queries))
+    expansion = 1
+    while True:
+        params = expand_parameters(config, expansion)
+        distances, indices = index.search(queries[remaining], k, params=search_parameters(params, selector))
+        for query_idx, row, row_distances in zip(remaining, indices, distances):
+            found[query_idx] = row[row >= 0]
+            scores[query_idx] = sign * row_distances[row >= 0]
+
+        remaining = np.array([i for i in remaining if len(found[i]) < k], dtype=np.int64)
+        if (len(remaining) == 0 or expansion >= max_expansion
+                or expand_parameters(config, expansion * EXPANSION_FACTOR) == params):
+            return found, scores
+        expansion *= EXPANSION_FACTOR
+
+
+def coverage_ranking(covered: np.ndarray, lengths: np.ndarray, embeddings: np.ndarray, candidates: np.ndarray,
+                     query_embs: list, weight: float = COVERAGE_WEIGHT) -> Ranking:
+    """
+    Rank the candidate recipes by the fraction of their ingredients the user has, blended with their similarity to
+    the query. Coverage is exact over all candidates; only the COVERAGE_CANDIDATES best-covered ones are compared to
+    the query, since similarity needs their embeddings.
+    :param covered: The number of the user's ingredients every recipe contains, see IngredientIndex.coverage().
+    :param lengths: The number of ingredients of every recipe.
+    :param embeddings: The normalized recipe embeddings.
+    :param candidates: A boolean array with one entry per recipe, True for the recipes that may be returned.
+    :param query_embs: The query embeddings whose mean similarity is blended in.
+    :param weight: The weight of coverage in the blended score, with 1 - weight for similarity.
+    :return: The best-covered candidate recipes, with their coverage as pool scores and the blended scores.
+    """
+    recipe_idxs = np.flatnonzero(candidates)
+    fractions = covered[recipe_idxs] / np.maximum(lengths[recipe_idxs], 1)
+    if len(recipe_idxs) > COVERAGE_CANDIDATES:
+        best = np.sort(np.argpartition(-fractions, COVERAGE_CANDIDATES)[:COVERAGE_CANDIDATES])
+        recipe_idxs, fractions = recipe_idxs[best], fractions[best]
+
+    sims = embeddings[recipe_idxs] @ np.mean(query_embs, axis=0)
+    scores = weight * fractions + (1 - weight) * sims
+    return Ranking(recipe_idxs, fractions, scores)
+
+
+def pool_size(key: SearchKey) -> int:
+    """
+    :param key: The query_key() of a search.
+    :return: The number of candidates with the best pool scores that are re-ranked by their final scores: the
+    best-covered candidates of coverage searches, the candidates re-ranked by keyword similarity of searches with
+    keywords, and just the top_k results otherwise.
+    """
+    if key.mode == "coverage":
+        return COVERAGE_CANDIDATES
+    return max(KEYWORD_CANDIDATES, key.top_k) if key.user_keywords else key.top_k
+
+
+def best_ranked(ranking: Ranking, top_k: int) -> np.ndarray:
+    """
+    :param ranking: The candidate recipes of a search.
+    :param top_k: The number of results of the search.
+    :return: The indexes in the ranking of the top_k candidates by their final scores, best first.
+    """
+    return np.argsort(-ranking.scores, kind="stable")[:top_k]
+
+
+class SearchResults(list):
+    """
+    The recipes found by a search, best first.
+    exhausted is True if fewer recipes than requested were found, either because fewer recipes pass the filters or
+    because the search gave up after widening it max_expansion times.
+    """
+
+    def __init__(self, recipes, exhausted: bool):
+        super().__init__(recipes)
+        self.exhausted = exhausted
+
+
+def check_metric(index, config: dict) -> None:
+    """
+    Make sure the index ranks by the metric recorded in its config. Queries are encoded normalized, so rankings are
+    only cosine similarities for inner-product indexes over normalized embeddings, which faiss_index.py builds.
+    :param index: The FAISS index.
+    :param config: The index config written by faiss_index.py.
+    """
+    metric = config.get("metric", "l2")
+    if index.metric_type != METRICS[metric]:
+        raise ValueError(f"The index config says the index uses the {metric} metric, but it uses FAISS metric "
+                         f"{index.metric_type}. Rebuild the index with faiss_index.py.")
+    if metric != "inner_product":
+        warnings.warn("The index uses L2 distance over unnormalized embeddings, so results are not ranked by cosine "
+                      "similarity. Rebuild the index with faiss_index.py.")
+
+
+def read_index(path: str, index_type: str, mmap: bool = True) -> tuple:
+    """
+    Read a FAISS index, memory-mapped if its type supports it. A mapped index is read-only and backed by the OS page
+    cache, so it loads almost instantly and every process mapping the same file shares one physical copy.
+    :param path: The index file.
+    :param index_type: The type of the index, see faiss_index.create_index().
+    :param mmap: Whether to memory-map the index instead of reading it into memory.
+    :return: The index, and whether it is memory-mapped.
+    """
+    flags = MMAP_FLAGS.get(index_type)
+    if mmap and flags is None:
+        warnings.warn(f"This FAISS version cannot memory-map {index_type} indexes, so the index is read into memory.")
+    elif mmap:
+        try:
+            return faiss.read_index(path, flags), True
+        except RuntimeError as e:
+            warnings.warn(f"Could not memory-map the index, so it is read into memory: {e}")
+    return faiss.read_index(path), False
+
+
+def resident_memory() -> tuple:
+    """
+    :return: The private and the shared (file-backed) resident memory of the process in bytes, or None where
+    /proc is not available.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            status = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None
+    return tuple(int(status[field].split()[0]) * 1024 for field in ["RssAnon", "RssFile"])
+
+
+class QuantizedEmbeddings:
+    """
+    A matrix of embeddings stored in reduced precision. Indexing it dequantizes only the selected rows to float32, so
+    re-ranking a few candidates never expands the whole matrix.
+    """
+
+    def __init__(self, codes: np.ndarray, scale: np.ndarray = None):
+        """
+        :param codes: The stored float16 or int8 matrix, which may be memory-mapped.
+        :param scale: The per-dimension scale of int8 codes, see quantize_embeddings(), or None for float16.
+        """
+        self.codes = codes
+        self.scale = scale
+        self.shape = codes.shape
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, idx) -> np.ndarray:
+        rows = self.codes[idx].astype(np.float32)
+        if self.scale is not None:
+            rows *= self.scale
+        return rows
+
+
+def embedding_scale(embeddings: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+    """
+    :param embeddings: A float32 embedding matrix, which may be memory-mapped.
+    :param batch_size: The number of rows read at once.
+    :return: The per-dimension scale that maps the largest absolute value of every dimension to 127.
+    """
+    max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+    for i in range(0, len(embeddings), batch_size):
+        np.maximum(max_abs, np.abs(embeddings[i:i + batch_size]).max(axis=0), out=max_abs)
+    return np.maximum(max_abs, np.finfo(np.float32).tiny) / 127
+
+
+def quantize_embeddings(embeddings: np.ndarray, precision: str, scale: np.ndarray = None) -> np.ndarray:
+    """
+    :param embeddings: Float32 embeddings.
+    :param precision: float32, float16 or int8.
+    :param scale: The per-dimension scale of int8 codes, see embedding_scale(). Values beyond it are clipped.
+    :return: The embeddings as stored in the given precision.
+    """
+    if precision == "int8":
+        return np.clip(np.rint(embeddings / scale), -127, 127).astype(np.int8)
+    return embeddings.astype(PRECISIONS[precision])
 
-        candidate_embs = np.array([index.reconstruct(int(idx)) for idx in indices[0]])
-        sims = candidate_embs @ keyword_emb
 
-        sorted_indices = np.argsort(-sims)[:500]
-        filtered = indices[0][sorted_indices]
+def load_embeddings(artifact_dir: str, dim: int, mmap: bool = True, precision: str = "float32",
+                    scale: list = None):
+    """
+    Load the matrix of normalized recipe embeddings, with one row per recipe in index order.
+    :param artifact_dir: The directory containing the files written by faiss_index.py.
+    :param dim: The embedding dimension.
+    :param mmap: Whether to memory-map the file instead of reading it into memory.
+    :param precision: The precision the embeddings are stored in, float32, float16 or int8.
+    :param scale: The per-dimension scale of int8 embeddings.
+    :return: The embedding matrix, or QuantizedEmbeddings that dequantize the rows they are indexed with.
+    """
+    path = os.path.join(artifact_dir, EMBEDDINGS_FILE)
+    dtype = PRECISIONS[precision]
+    if mmap:
+        codes = map_array(path, dtype).reshape(-1, dim)
     else:
-        filtered = indices[0]
+        codes = np.fromfile(path, dtype=dtype).reshape(-1, dim)
+
+    if precision == "float32":
+        return codes
+    return QuantizedEmbeddings(codes, np.array(scale, dtype=np.float32) if scale is not None else None)
+
+
+def artifact_files(artifact_dir: str) -> list:
+    """
+    :param artifact_dir: The directory containing the files written by faiss_index.py.
+    :return: The paths of the artifact files a search engine is loaded from.
+    """
+    names = [
+        INDEX_FILE, CONFIG_FILE, EMBEDDINGS_FILE, VOCAB_FILE, TABLE_FILE, RESTRICTIONS_FILE, VOCABULARY_FILE
+    ] + STORE_FILES
+    return [os.path.join(artifact_dir, name) for name in names]
+
+
+class BaseSearchEngine:
+    """
+    What SearchEngine and sharded_search.ShardedSearchEngine share: the embedding model, the caches of search
+    results and query embeddings, reloading changed artifacts, and running searches through the result cache.
+    Subclasses load their artifacts and find the recipes of the searches that are not cached.
+    Nothing is loaded on construction: the artifacts are loaded on first use, and the model (along with torch)
+    only when a query actually needs to be encoded.
+    Search results are cached by their canonical search parameters until the artifacts change, and query embeddings
+    by their text.
+    """
+
+    def __init__(self, artifact_dir: str = "search", model_name: str = MODEL_NAME,
+                 result_cache_size: int = RESULT_CACHE_SIZE, embedding_cache_size: int = EMBEDDING_CACHE_SIZE,
+                 cache_ttl: float = CACHE_TTL, embedding_cache_path: str = None):
+        """
+        :param artifact_dir: The directory containing the files written by faiss_index.py.
+        :param model_name: The name of the SentenceTransformer model the index was built with.
+        :param result_cache_size: The maximum number of cached searches.
+        :param embedding_cache_size: The maximum number of query embeddings cached in memory.
+        :param cache_ttl: The number of seconds cached searches and query embeddings stay valid.
+        :param embedding_cache_path: A SQLite database in which query embeddings are persisted across restarts,
+        or None to only cache them in memory.
+        """
+        self.artifact_dir = artifact_dir
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._model = None
+        self._artifacts = None
+        self._signature = None
+        self.result_cache = QueryCache(result_cache_size, cache_ttl)
+        self.embedding_cache = EmbeddingCache(model_name, embedding_cache_size, cache_ttl, embedding_cache_path)
+
+    def artifact_files(self) -> list:
+        """
+        :return: The paths of the artifact files the engine is loaded from.
+        """
+        raise NotImplementedError
+
+    def artifact_signature(self) -> tuple:
+        """
+        Identify the current version of the artifact files on disk.
+        :return: The modification time of each artifact file, or None for missing files.
+        """
+        return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in self.artifact_files())
 
-    user_set = set(normalize_ingredient(i) for i in user_ingredients)
-    avoid_set = set(normalize_ingredient(i) for i in avoid_ingredients)
-    results = []
+    def reload_if_changed(self) -> bool:
+        """
+        Drop the loaded artifacts and the cached search results if the files changed on disk since they were loaded,
+        so the next search loads the new ones. The model and the cached query embeddings are kept.
+        :return: Whether the artifacts were dropped.
+        """
+        with self._lock:
+            if self._signature is None or self._signature == self.artifact_signature():
+                return False
+            self._artifacts = None
+            self._signature = None
+            self.result_cache.clear()
+            return True
 
-    for idx in filtered:
-        if idx == -1 or idx < 0 or idx >= len(recipes):
-            continue
+    def _load_artifacts(self) -> dict:
+        """
+        Load the artifacts, unless they are already loaded, and set _signature to the artifact_signature() they were
+        loaded with.
+        :return: The loaded artifacts by name, with at least the ingredient index. A search should use one returned
+        dict throughout, since a reload replaces it.
+        """
+        raise NotImplementedError
 
-        recipe = recipes[idx]
-        ingredient_lines = recipe["ingredients"].split("\n")
-        recipe_ing_set = set(normalize_ingredient(line) for line in ingredient_lines if line.strip())
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer  # imports torch, so only on first use
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
 
-        if mode == "inclusive":
-            ing_overlap = recipe_ing_set.intersection(user_set)
-            avoid_overlap = recipe_ing_set.intersection(avoid_set)
-            if len(ing_overlap) > 0 and len(avoid_overlap) == 0:
-                results.append(recipe)
+    @property
+    def ingredient_index(self) -> IngredientIndex:
+        return self._load_artifacts()["ingredient_index"]
 
-        elif mode == "exclusive":
-            if recipe_ing_set.issubset(user_set):
-                results.append(recipe)
+    def cache_info(self) -> dict:
+        """
+        :return: The hits, misses and size of the search result and query embedding caches.
+        """
+        return {"results": self.result_cache.stats(), "embeddings": self.embedding_cache.stats()}
 
-        if len(results) >= top_k:
-            break
+    def encode(self, texts: list, batch_size: int = 32) -> np.ndarray:
+        """
+        Encode query texts normalized. Only texts whose embeddings are not cached are passed to the model.
+        :param texts: The query texts.
+        :param batch_size: The number of texts the model encodes at once.
+        :return: The query embeddings, one row per text.
+        """
+        embeddings = [self.embedding_cache.get(text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
 
-    return results
+        if missing:
+            encoded = self.model.encode(
+                [texts[i] for i in missing], batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True,
+                show_progress_bar=False
+            ).astype("float32")
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+                self.embedding_cache.put(texts[i], embedding)
+
+        return np.stack(embeddings)
+
+    def search_faiss_and_filter(self, user_ingredients, avoid_ingredients, user_keywords, mode="inclusive",
+                                top_k=10, restrictions=(), max_expansion=MAX_EXPANSION, max_missing=None,
+                                coverage_weight=COVERAGE_WEIGHT):
+        """
+        Retrieves search results given the user's search parameters.
+        :param user_ingredients: List of the user's search ingredients
+        :param avoid_ingredients: List of ingredients the user would like to avoid
+        :param user_keywords: Additional search keywords that the user can optionally add
+        :param mode: Selection type: inclusive or exclusive, which are ranked by similarity, or coverage, which is
+        ranked by the fraction of each recipe's ingredients the user has, see coverage_ranking()
+        :param top_k: The number of results to retrieve
+        :param restrictions: Names of the dietary restrictions the results must comply with
+        :param max_expansion: The largest factor the search-time parameters of approximate indexes are multiplied by
+        to find top_k results, see expanding_search()
+        :param max_missing: The maximum number of ingredients a result may need that the user doesn't have, or None
+        for no limit
+        :param coverage_weight: The weight of coverage in the score of the coverage mode, with 1 - coverage_weight
+        for similarity
+        :return: The filtered search results, as SearchResults
+        """
+        return self.search_many([{
+            "user_ingredients": user_ingredients,
+            "avoid_ingredients": avoid_ingredients,
+            "user_keywords": user_keywords,
+            "mode": mode,
+            "top_k": top_k,
+            "restrictions": restrictions,
+            "max_expansion": max_expansion,
+            "max_missing": max_missing,
+            "coverage_weight": coverage_weight
+        }])[0]
+
+    @staticmethod
+    def query_key(user_ingredients, avoid_ingredients, user_keywords, mode="inclusive", top_k=10, restrictions=(),
+                  max_expansion=MAX_EXPANSION, max_missing=None, coverage_weight=COVERAGE_WEIGHT) -> SearchKey:
+        """
+        Canonicalize the parameters of a search, so searches that differ only in ingredient order, duplicates or
+        whitespace share one cache entry. The parameters are those of search_faiss_and_filter().
+        :return: The canonical search parameters.
+        """
+        return SearchKey(
+            user_names=tuple(sorted(set(normalize_ingredient(i) for i in user_ingredients))),
+            mode=mode,
+            avoid_names=tuple(sorted(set(normalize_ingredient(i) for i in avoid_ingredients))),
+            user_keywords=" ".join(user_keywords.split()) if user_keywords else "",
+            top_k=top_k,
+            restrictions=tuple(sorted(set(restrictions))),
+            max_expansion=max_expansion,
+            max_missing=max_missing,
+            coverage_weight=coverage_weight if mode == "coverage" else None
+        )
+
+    @staticmethod
+    def query_texts(key: SearchKey) -> list:
+        """
+        :param key: The query_key() of a search.
+        :return: The texts encoded for the search: its ingredients, and its keywords if it has any.
+        """
+        return [", ".join(key.user_names)] + ([key.user_keywords] if key.user_keywords else [])
+
+    def find_recipes(self, keys: list, artifacts: dict, timings: dict, query_embeddings: dict = None) -> list:
+        """
+        Find the results of searches that are not cached.
+        :param keys: The query_key() of every search.
+        :param artifacts: The artifacts to search, see _load_artifacts().
+        :param timings: A dict to which the seconds spent in each stage of the searches are added.
+        :param query_embeddings: Optional embeddings of the query_texts() of the searches by text. Texts without one
+        are encoded.
+        :return: The recipes found by every search, best first.
+        """
+        raise NotImplementedError
+
+    def search_many(self, queries: list, timings: dict = None, query_embeddings: dict = None) -> list:
+        """
+        Run several searches at once. The queries that are not cached are searched together, see find_recipes().
+        :param queries: The searches, each a dict of search_faiss_and_filter() keyword arguments.
+        :param timings: An optional dict to which the seconds spent in each stage of the searches are added.
+        :param query_embeddings: Optional embeddings of the query_texts() of the searches by text, e.g. encoded by
+        another process. Texts without one are encoded.
+        :return: The results of every search, as SearchResults.
+        """
+        timings = {} if timings is None else timings
+        generation = self.result_cache.generation  # results of artifacts dropped by a reload meanwhile aren't cached
+
+        results = [None] * len(queries)
+        pending = {}  # query key -> positions of the queries with that key
+        for query_idx, query in enumerate(queries):
+            key = self.query_key(**query)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                results[query_idx] = SearchResults(*cached)
+            else:
+                pending.setdefault(key, []).append(query_idx)
+
+        if not pending:
+            return results
+
+        artifacts = self._load_artifacts()  # one snapshot for finding and fetching, even if a reload happens between
+        found = self.find_recipes(list(pending), artifacts, timings, query_embeddings)
+        for (key, query_idxs), recipes in zip(pending.items(), found):
+            exhausted = len(recipes) < key.top_k
+            self.result_cache.put(key, (recipes, exhausted), generation)
+            for query_idx in query_idxs:
+                results[query_idx] = SearchResults(recipes, exhausted)
+
+        return results
+
+
+class SearchEngine(BaseSearchEngine):
+    """
+    Holds the embedding model, FAISS index, recipe embeddings, recipe store and ingredient index of one artifact
+    directory.
+    Searches with the same filters share one FAISS search, see rank_many().
+    """
+
+    def __init__(self, artifact_dir: str = "search", model_name: str = MODEL_NAME, mmap_embeddings: bool = True,
+                 mmap_index: bool = True, **cache_options):
+        """
+        :param artifact_dir: The directory containing the files written by faiss_index.py.
+        :param model_name: The name of the SentenceTransformer model the index was built with.
+        :param mmap_embeddings: Whether to memory-map the recipe embedding matrix instead of reading it into memory.
+        :param mmap_index: Whether to memory-map the FAISS index instead of reading it into memory.
+        :param cache_options: The cache options of BaseSearchEngine.
+        """
+        super().__init__(artifact_dir, model_name, **cache_options)
+        self.mmap_embeddings = mmap_embeddings
+        self.mmap_index = mmap_index
+
+    def artifact_files(self) -> list:
+        """
+        :return: The paths of the artifact files the engine is loaded from.
+        """
+        return artifact_files(self.artifact_dir)
+
+    def _load_artifacts(self) -> dict:
+        """
+        Load the FAISS index and its config, recipe embeddings, recipe store and ingredient index, unless they are
+        already loaded, and print how long the index took to load and how much memory it holds. Indexes built before
+        index configs were written are exact (flat) L2 indexes.
+        :return: The loaded artifacts by name. A search should use one returned dict throughout, since a reload
+        replaces it.
+        """
+        with self._lock:
+            if self._artifacts is None:
+                self._signature = self.artifact_signature()
+                config_path = os.path.join(self.artifact_dir, CONFIG_FILE)
+                config = None
+                if os.path.exists(config_path):
+                    with open(config_path, "r") as f:
+                        config = json.load(f)
+                index_type = config["index_type"] if config else "flat"
+
+                memory = resident_memory()
+                start = time.perf_counter()
+                index, mapped = read_index(os.path.join(self.artifact_dir, INDEX_FILE), index_type, self.mmap_index)
+                elapsed = time.perf_counter() - start
+                if config is None:
+                    config = {"index_type": "flat", "metric": "l2", "dim": index.d}
+                check_metric(index, config)
+
+                size = os.path.getsize(os.path.join(self.artifact_dir, INDEX_FILE))
+                message = (f"Loaded the {index_type} index of {index.ntotal} recipes ({size / 2 ** 20:.1f} MB) "
+                           f"{'memory-mapped' if mapped else 'into memory'} in {elapsed * 1000:.0f} ms")
+                if memory:
+                    private, shared = (after - before for after, before in zip(resident_memory(), memory))
+                    message += f", resident: {private / 2 ** 20:.1f} MB private, {shared / 2 ** 20:.1f} MB shared"
+                print(message + ".")
+
+                self._artifacts = {
+                    "index": index,
+                    "config": config,
+                    "embeddings": load_embeddings(
+                        self.artifact_dir, config["dim"], self.mmap_embeddings, config.get("precision", "float32"),
+                        config.get("embedding_scale")
+                    ),
+                    "recipes": RecipeStore(self.artifact_dir),
+                    "ingredient_index": IngredientIndex.load(self.artifact_dir)
+                }
+            return self._artifacts
+
+    @property
+    def index(self):
+        return self._load_artifacts()["index"]
+
+    @property
+    def config(self) -> dict:
+        return self._load_artifacts()["config"]
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self._load_artifacts()["embeddings"]
+
+    @property
+    def recipes(self) -> RecipeStore:
+        return self._load_artifacts()["recipes"]
+
+    def rank_many(self, keys: list, timings: dict = None, query_embeddings: dict = None,
+                  artifacts: dict = None) -> list:
+        """
+        Filter and rank the recipes of several searches, without fetching them. The texts of the searches are encoded
+        in one batch, and searches with the same filters share one FAISS search.
+        :param keys: The query_key() of every search.
+        :param timings: An optional dict to which the seconds spent filtering, encoding and searching are added.
+        :param query_embeddings: Optional embeddings of the query_texts() of the searches by text, e.g. encoded by
+        another process. Texts without one are encoded.
+        :param artifacts: The artifacts to rank with, see _load_artifacts(), or None for those currently loaded. The
+        positions of the rankings are those of their recipe store.
+        :return: The Ranking of every search. Its pool holds at most pool_size(key) candidates, and best_ranked()
+        selects the results.
+        """
+        timings = {} if timings is None else timings
+
+        def record(stage, start):
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+        def search_filter(key):  # the parameters that decide the candidates of a search
+            return key.user_names, key.mode, key.avoid_names, key.restrictions, key.max_missing
+
+        artifacts = artifacts or self._load_artifacts()
+        ingredient_index = artifacts["ingredient_index"]
+
+        start = time.perf_counter()
+        filters = {}  # filter -> candidate mask, shared by the queries that only differ in keywords or top_k
+        for key in keys:
+            if search_filter(key) not in filters:
+                candidates = ingredient_index.candidates(
+                    ingredient_index.lookup(key.user_names), ingredient_index.lookup(key.avoid_names), key.mode,
+                    key.restrictions, key.max_missing
+                )
+                filters[search_filter(key)] = candidates & ~artifacts["recipes"].deleted
+        record("filter", start)
+
+        start = time.perf_counter()
+        searched = [key for key in keys if filters[search_filter(key)].any()]
+        query_embs = dict(query_embeddings or {})
+        texts = sorted(set(text for key in searched for text in self.query_texts(key)) - set(query_embs))
+        if texts:
+            query_embs.update(zip(texts, self.encode(texts)))
+        record("encode", start)
+
+        start = time.perf_counter()
+        empty = np.empty(0, dtype=np.int64)
+        rankings = {key: Ranking(empty, empty.astype(np.float32), empty.astype(np.float32)) for key in keys}
+        groups = {}  # (filter, k, max_expansion) -> the keys searched together
+        for key in searched:
+            if key.mode == "coverage":
+                # coverage rankings already blend in the keywords
+                rankings[key] = coverage_ranking(
+                    ingredient_index.coverage(ingredient_index.lookup(key.user_names)), ingredient_index.lengths,
+                    artifacts["embeddings"], filters[search_filter(key)],
+                    [query_embs[text] for text in self.query_texts(key)], key.coverage_weight
+                )
+            else:
+                groups.setdefault((search_filter(key), pool_size(key), key.max_expansion), []).append(key)
+
+        for (group_filter, k, max_expansion), group in groups.items():
+            batch = np.stack([query_embs[", ".join(key.user_names)] for key in group])
+            for key, filtered, sims in zip(group, *expanding_search(
+                    artifacts["index"], artifacts["config"], batch, filters[group_filter], k, max_expansion)):
+                scores = sims
+                if key.user_keywords:  # searches with keywords re-rank their candidates by keyword similarity
+                    scores = artifacts["embeddings"][filtered] @ query_embs[key.user_keywords]
+                rankings[key] = Ranking(filtered, sims, scores)
+        record("search", start)
+
+        return [rankings[key] for key in keys]
+
+    def find_recipes(self, keys: list, artifacts: dict, timings: dict, query_embeddings: dict = None) -> list:
+        """
+        Rank the searches, see rank_many(), and fetch their results. The seconds spent filtering, encoding, searching
+        and fetching recipes are added to timings.
+        """
+        rankings = self.rank_many(keys, timings, query_embeddings, artifacts)
+        recipe_store = artifacts["recipes"]
+
+        start = time.perf_counter()
+        found = [
+            [recipe_store[idx] for idx in ranking.positions[best_ranked(ranking, key.top_k)]]
+            for key, ranking in zip(keys, rankings)
+        ]
+        timings["fetch"] = timings.get("fetch", 0.0) + time.perf_counter() - start
+        return found
 
 
 def print_full_recipes(recipes: list) -> None:
@@ -98,6 +723,20 @@ def print_full_recipes(recipes: list) -> None:
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='search.py',
+        description='Run an example search against a FAISS index.'
+    )
+    parser.add_argument(
+        '-d', '--artifact_dir',
+        type=str,
+        default='search',
+        help='The directory containing the index and metadata written by faiss_index.py.'
+    )
+    args = parser.parse_args()
+
+    engine = SearchEngine(args.artifact_dir)
+
     # Example usage
     user_ing = ["onion", "garlic", "butter"]
     avoid_list = []
@@ -105,10 +744,7 @@ if __name__ == '__main__':
     user_keywords = "sauce"
     top_k = 5
 
-    matched_recipes = search_faiss_and_filter(
-        model=model,
-        index=index,
-        recipes=recipes,
+    matched_recipes = engine.search_faiss_and_filter(
         user_ingredients=user_ing,
         avoid_ingredients=avoid_list,
         user_keywords=user_keywords,
@@ -116,3 +752,4 @@ if __name__ == '__main__':
         top_k=top_k
     )
     print_full_recipes(matched_recipes)
+    print(engine.cache_info())
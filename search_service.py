@@ -0,0 +1,212 @@
+import argparse
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from search import BaseSearchEngine
+from sharded_search import open_engine
+
+WINDOW_MS = 5.0  # how long the service waits for more queries after the first one of a batch
+MAX_BATCH_SIZE = 64
+STAGES = ["queue", "failed_batch", "filter", "encode", "search", "fetch"]
+
+
+class SearchService:
+    """
+    Runs the searches of concurrent clients in micro-batches on a worker thread.
+    The worker takes the first waiting query, collects the queries arriving within the next window_ms milliseconds
+    (up to max_batch_size of them), and runs them through SearchEngine.search_many(), which encodes them in one batch
+    and searches queries with the same filters together. Clients block on search() or wait on the future returned
+    by submit().
+    """
+
+    def __init__(self, engine: BaseSearchEngine, window_ms: float = WINDOW_MS, max_batch_size: int = MAX_BATCH_SIZE):
+        """
+        :param engine: The search engine the searches are run with.
+        :param window_ms: How long to wait for more queries after the first query of a batch, in milliseconds.
+        :param max_batch_size: The maximum number of queries per batch.
+        """
+        self.engine = engine
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._seconds = Counter()
+        self._max_queue_depth = 0
+        self._requests = 0
+        self._worker = threading.Thread(target=self._run, name="search-service", daemon=True)
+        self._worker.start()
+
+    def submit(self, **query) -> Future:
+        """
+        Queue a search.
+        :param query: The search_faiss_and_filter() keyword arguments of the search.
+        :return: A future that resolves to the SearchResults of the search.
+        """
+        future = Future()
+        self._queue.put((query, future, time.perf_counter()))
+        return future
+
+    def search(self, timeout: float = None, **query):
+        """
+        Run a search and wait for its results.
+        :param timeout: The maximum number of seconds to wait, or None to wait indefinitely.
+        :param query: The search_faiss_and_filter() keyword arguments of the search.
+        :return: The SearchResults of the search.
+        """
+        return self.submit(**query).result(timeout)
+
+    def close(self) -> None:
+        """
+        Stop the worker once the queued searches are done.
+        """
+        self._queue.put(None)
+        self._worker.join()
+
+    def _run(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+
+            batch = [request]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)  # stop after this batch
+                    break
+                batch.append(request)
+
+            self._process(batch)
+
+    def _process(self, batch: list) -> None:
+        """
+        Run a batch of searches and resolve their futures. If the batch fails, e.g. because one query names an
+        unknown dietary restriction, its searches are run one by one so only the failing ones get the exception.
+        Every search of a batch waits for all of its stages, while a search run one by one only waits for its own,
+        and the time the failed batch took is counted separately.
+        :param batch: The queued (query, future, submission time) of every search in the batch.
+        """
+        start = time.perf_counter()
+        depth = self._queue.qsize()
+        timings = {}
+
+        try:
+            results = self.engine.search_many([query for query, _, _ in batch], timings)
+        except Exception:
+            results = None
+
+        failed = 0.0
+        if results is not None:
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        else:
+            failed = time.perf_counter() - start
+            timings = {}  # the stages of the retries, without those the failed batch got through
+            for query, future, _ in batch:
+                try:
+                    future.set_result(self.engine.search_many([query], timings)[0])
+                except Exception as e:
+                    future.set_exception(e)
+
+        with self._stats_lock:
+            self._requests += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._max_queue_depth = max(self._max_queue_depth, depth + len(batch))
+            self._seconds["queue"] += sum(start - submitted for _, _, submitted in batch)
+            self._seconds["failed_batch"] += failed * len(batch)
+            waiting = len(batch) if results is not None else 1  # the searches of the batch waiting for each stage
+            for stage, seconds in timings.items():
+                self._seconds[stage] += seconds * waiting
+
+    def stats(self) -> dict:
+        """
+        :return: The number of searches and batches served, the current and maximum queue depth, the number of
+        batches of each size, and the mean latency of every stage per search in milliseconds.
+        """
+        with self._stats_lock:
+            requests = max(self._requests, 1)
+            return {
+                "requests": self._requests,
+                "batches": sum(self._batch_sizes.values()),
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_queue_depth,
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "latency_ms": {stage: 1000 * self._seconds[stage] / requests for stage in STAGES}
+            }
+
+
+def benchmark(service: SearchService, queries: list, users: int) -> float:
+    """
+    Simulate concurrent users, each running searches one after the other.
+    :param service: The search service.
+    :param queries: The searches, each a dict of search_faiss_and_filter() keyword arguments.
+    :param users: The number of concurrent users.
+    :return: The number of searches per second.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(users) as executor:
+        list(executor.map(lambda query: service.search(**query), queries))
+    return len(queries) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='search_service.py',
+        description='Measure the throughput of the micro-batching search service under concurrent users.'
+    )
+    parser.add_argument(
+        '-d', '--artifact_dir',
+        type=str,
+        default='search',
+        help='The directory containing the index and metadata written by faiss_index.py.'
+    )
+    parser.add_argument(
+        '--users',
+        type=int,
+        nargs='+',
+        default=[1, 4, 16],
+        help='The numbers of concurrent users to measure.'
+    )
+    parser.add_argument(
+        '--queries',
+        type=int,
+        default=256,
+        help='The number of searches per measurement.'
+    )
+    parser.add_argument(
+        '--window_ms',
+        type=float,
+        default=WINDOW_MS,
+        help='How long to wait for more queries after the first query of a batch, in milliseconds.'
+    )
+    args = parser.parse_args()
+
+    # measure searches, not cache hits
+    engine = open_engine(args.artifact_dir, result_cache_size=1, embedding_cache_size=1)
+    vocab = engine.ingredient_index.vocab
+    example_queries = [
+        {
+            "user_ingredients": [vocab[i % len(vocab)], vocab[(7 * i + 3) % len(vocab)]],
+            "avoid_ingredients": [],
+            "user_keywords": "",
+            "mode": "inclusive",
+            "top_k": 10
+        }
+        for i in range(args.queries)
+    ]
+
+    for users in args.users:
+        service = SearchService(engine, window_ms=args.window_ms)
+        qps = benchmark(service, example_queries, users)
+        service.close()
+        stats = service.stats()
+        print(f"{users} users: {qps:.1f} searches/s, batch sizes {stats['batch_sizes']}, "
+              f"max queue depth {stats['max_queue_depth']}")
+        print("  latency per search: " + ", ".join(f"{stage} {ms:.2f} ms" for stage, ms in stats["latency_ms"].items()))
@@ -0,0 +1,266 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import faiss
+import numpy as np
+from ingredient_index import IngredientIndex
+from recipe_store import RecipeStore
+from vocabulary import VOCABULARY_FILE
+from search import BaseSearchEngine, SearchEngine, SearchKey, Ranking, MODEL_NAME, artifact_files, pool_size, \
+    best_ranked
+
+SHARDS_FILE = "shards.json"
+SHARD_DIR = "shard_{}"
+
+_engines = {}  # the search engine of every shard opened by this process, by shard directory
+
+
+def read_shards(artifact_dir: str) -> list:
+    """
+    :param artifact_dir: A directory written by faiss_index.py build --shards.
+    :return: The directories of the shards, relative to the artifact directory.
+    """
+    with open(os.path.join(artifact_dir, SHARDS_FILE), "r") as f:
+        return json.load(f)["shards"]
+
+
+def vocabulary_file(artifact_dir: str) -> str:
+    """
+    :param artifact_dir: The directory containing the files written by faiss_index.py.
+    :return: The canonical ingredient vocabulary that the ingredient index of the directory uses, that of the first
+    shard for a sharded index, since all shards share it.
+    """
+    if os.path.exists(os.path.join(artifact_dir, SHARDS_FILE)):
+        artifact_dir = os.path.join(artifact_dir, read_shards(artifact_dir)[0])
+    return os.path.join(artifact_dir, VOCABULARY_FILE)
+
+
+def init_worker() -> None:
+    """
+    Let every worker process search with one thread, since the workers already search the shards in parallel.
+    """
+    faiss.omp_set_num_threads(1)
+
+
+def search_shard(task: tuple) -> list:
+    """
+    Filter, search and rank the recipes of one shard, in a worker process or in the calling process. The process
+    opens the shard on its first search and keeps it open.
+    :param task: The shard directory, the query_key() of every search, their embeddings by text, and the SearchEngine
+    options of the shard.
+    :return: The Ranking of every search in the shard.
+    """
+    shard_dir, keys, query_embeddings, options = task
+    if shard_dir not in _engines:
+        _engines[shard_dir] = SearchEngine(shard_dir, **options)
+    return _engines[shard_dir].rank_many(keys, query_embeddings=query_embeddings)
+
+
+def merge_rankings(rankings: list, key: SearchKey) -> list:
+    """
+    Merge the rankings of a search in every shard as if the shards were one index: of the candidates with the best
+    pool scores across the shards, the best by their final scores are the results.
+    :param rankings: The Ranking of the search in every shard.
+    :param key: The query_key() of the search.
+    :return: The shard and the position in the shard of every result, best first.
+    """
+    shards = np.concatenate([np.full(len(ranking.positions), shard) for shard, ranking in enumerate(rankings)])
+    merged = Ranking(*(np.concatenate(field) for field in zip(*rankings)))
+    pool = np.argsort(-merged.pool_scores, kind="stable")[:pool_size(key)]
+    best = pool[best_ranked(Ranking(*(field[pool] for field in merged)), key.top_k)]
+    return list(zip(shards[best], merged.positions[best]))
+
+
+class ShardedSearchEngine(BaseSearchEngine):
+    """
+    Searches an index split into shards by faiss_index.py build --shards.
+    Searches are encoded once in this process. Every shard is then filtered by the ingredients, avoided ingredients
+    and dietary restrictions of the searches, searched and scored on its own, in parallel on a pool of worker
+    processes, and the candidates of the shards are merged by score, see merge_rankings(). Only the results are
+    fetched, from the recipe stores of the shards.
+    Every shard is searched by the same worker, shard i by worker i % workers. The FAISS index and embeddings of a
+    shard are memory-mapped, but its ingredient tables are read into the memory of its worker, so each is held by
+    one worker only.
+    """
+
+    def __init__(self, artifact_dir: str = "search", model_name: str = MODEL_NAME, workers: int = None,
+                 mmap_embeddings: bool = True, mmap_index: bool = True, **cache_options):
+        """
+        :param artifact_dir: The directory written by faiss_index.py build --shards.
+        :param model_name: The name of the SentenceTransformer model the index was built with.
+        :param workers: The number of processes searching shards in parallel, by default one per shard up to the
+        number of CPUs. With 1, the shards are searched one after the other in this process.
+        :param mmap_embeddings: Whether to memory-map the recipe embedding matrices instead of reading them into memory.
+        :param mmap_index: Whether to memory-map the FAISS indexes instead of reading them into memory.
+        :param cache_options: The cache options of BaseSearchEngine, for the merged search results and query
+        embeddings.
+        """
+        super().__init__(artifact_dir, model_name, **cache_options)
+        self.workers = workers or min(len(read_shards(artifact_dir)), os.cpu_count() or 1)
+        # merged results are cached here, so the shards barely cache their own
+        self.shard_options = {
+            "mmap_embeddings": mmap_embeddings, "mmap_index": mmap_index, "result_cache_size": 1,
+            "embedding_cache_size": 1
+        }
+        self._pools = None  # one single-process pool per worker, so every shard stays on its worker
+
+    def artifact_files(self) -> list:
+        """
+        :return: The paths of the shard list and of the artifact files of every shard.
+        """
+        return [os.path.join(self.artifact_dir, SHARDS_FILE)] + [
+            path for shard_dir in read_shards(self.artifact_dir)
+            for path in artifact_files(os.path.join(self.artifact_dir, shard_dir))
+        ]
+
+    def _load_artifacts(self) -> dict:
+        """
+        Read the shard list and open the recipe stores of the shards, unless they are already open. Of the other
+        artifacts, only the ingredient index of the first shard is loaded in this process, for its vocabulary and
+        dietary restrictions, which all shards share.
+        :return: The shard directories, their recipe stores and the ingredient index.
+        """
+        with self._lock:
+            if self._artifacts is None:
+                self._signature = self.artifact_signature()
+                shard_dirs = [os.path.join(self.artifact_dir, name) for name in read_shards(self.artifact_dir)]
+                self._artifacts = {
+                    "shards": shard_dirs,
+                    "stores": [RecipeStore(shard_dir) for shard_dir in shard_dirs],
+                    "ingredient_index": IngredientIndex.load(shard_dirs[0])
+                }
+            return self._artifacts
+
+    def reload_if_changed(self) -> bool:
+        """
+        Drop the shard list, the recipe stores and the cached search results if the files of any shard changed on
+        disk since they were loaded, and stop the worker processes, so the next search reopens every shard.
+        :return: Whether the artifacts were dropped.
+        """
+        if not super().reload_if_changed():
+            return False
+        self.close()
+        _engines.clear()  # the shards opened by this process when searching without workers
+        return True
+
+    def map_shards(self, tasks: list) -> list:
+        """
+        :param tasks: One search_shard() task per shard.
+        :return: The results of every task, in order.
+        """
+        if self.workers == 1:
+            return list(map(search_shard, tasks))
+        with self._lock:  # submitted under the lock, so close() cannot stop the pools in between
+            if self._pools is None:
+                # spawned, not forked, since this process may already run the model's threads
+                context = multiprocessing.get_context("spawn")
+                self._pools = [context.Pool(1, initializer=init_worker) for _ in range(self.workers)]
+            results = [
+                self._pools[shard % len(self._pools)].apply_async(search_shard, (task,))
+                for shard, task in enumerate(tasks)
+            ]
+        return [result.get() for result in results]
+
+    def close(self) -> None:
+        """
+        Stop the worker processes, once the searches already submitted to them are done.
+        """
+        with self._lock:
+            pools, self._pools = self._pools or [], None
+        for pool in pools:
+            pool.close()
+        for pool in pools:
+            pool.join()
+
+    def find_recipes(self, keys: list, artifacts: dict, timings: dict, query_embeddings: dict = None) -> list:
+        """
+        Encode the searches in one batch, send them to every shard together and merge the rankings of the shards. The
+        seconds spent encoding, searching the shards, and merging and fetching their results are added to timings.
+        """
+        def record(stage, start):
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+        start = time.perf_counter()
+        query_embs = dict(query_embeddings or {})
+        texts = sorted(set(text for key in keys for text in self.query_texts(key)) - set(query_embs))
+        if texts:
+            query_embs.update(zip(texts, self.encode(texts)))
+        record("encode", start)
+
+        start = time.perf_counter()
+        shard_rankings = self.map_shards([
+            (shard_dir, keys, query_embs, self.shard_options) for shard_dir in artifacts["shards"]
+        ])
+        record("search", start)
+
+        start = time.perf_counter()
+        found = []
+        for key_idx, key in enumerate(keys):
+            best = merge_rankings([rankings[key_idx] for rankings in shard_rankings], key)
+            found.append([artifacts["stores"][shard][idx] for shard, idx in best])
+        record("fetch", start)
+        return found
+
+
+def open_engine(artifact_dir: str = "search", workers: int = None, **options) -> BaseSearchEngine:
+    """
+    :param artifact_dir: The directory containing the files written by faiss_index.py.
+    :param workers: The number of processes searching the shards of a sharded index, see ShardedSearchEngine.
+    :param options: Further SearchEngine options.
+    :return: A ShardedSearchEngine if the index was built with shards, else a SearchEngine.
+    """
+    if os.path.exists(os.path.join(artifact_dir, SHARDS_FILE)):
+        return ShardedSearchEngine(artifact_dir, workers=workers, **options)
+    return SearchEngine(artifact_dir, **options)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='sharded_search.py',
+        description='Measure the latency of searches over a sharded index with different numbers of worker processes.'
+    )
+    parser.add_argument(
+        '-d', '--artifact_dir',
+        type=str,
+        default='search',
+        help='The directory containing the shards written by faiss_index.py build --shards.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4],
+        help='The numbers of worker processes to measure.'
+    )
+    parser.add_argument(
+        '--queries',
+        type=int,
+        default=64,
+        help='The number of searches per measurement.'
+    )
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        # measure searches, not cache hits
+        engine = ShardedSearchEngine(args.artifact_dir, workers=workers, result_cache_size=1)
+        vocab = engine.ingredient_index.vocab
+        example_queries = [
+            {
+                "user_ingredients": [vocab[i % len(vocab)], vocab[(7 * i + 3) % len(vocab)]],
+                "avoid_ingredients": [],
+                "user_keywords": "",
+                "mode": "inclusive",
+                "top_k": 10
+            }
+            for i in range(args.queries)
+        ]
+        engine.search_faiss_and_filter(**example_queries[0])  # start the workers and open the shards
+
+        start = time.perf_counter()
+        for query in example_queries:
+            engine.search_faiss_and_filter(**query)
+        elapsed = time.perf_counter() - start
+        engine.close()
+        print(f"{workers} workers: {1000 * elapsed / len(example_queries):.2f} ms per search")
@@ -0,0 +1,106 @@
+import os
+import shutil
+import sys
+import zlib
+import numpy as np
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import faiss_index  # noqa: E402
+from search import BaseSearchEngine  # noqa: E402
+
+DIM = 16
+INGREDIENTS = ['onion', 'garlic', 'butter', 'milk', 'flour', 'sugar', 'egg', 'chicken', 'tomato', 'rice', 'beef',
+               'cheese', 'carrot', 'potato', 'salt']
+
+
+class HashModel:
+    """
+    Embeds every text as a random unit vector seeded by the text, so searches run without the SentenceTransformer
+    model.
+    """
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return DIM
+
+    def encode(self, texts: list, batch_size: int = 32, normalize_embeddings: bool = True, **kwargs) -> np.ndarray:
+        embeddings = np.stack([
+            np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(DIM) for text in texts
+        ]).astype('float32')
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def make_recipes(count: int) -> list:
+    """
+    :param count: The number of recipes.
+    :return: Recipes of three to six ingredients each.
+    """
+    rng = np.random.default_rng(0)
+    recipes = []
+    for i in range(count):
+        names = rng.choice(INGREDIENTS, rng.integers(3, 7), replace=False)
+        recipes.append({
+            'title': f'Recipe {i}',
+            'ingredients': '\n'.join(f'- 1 c. {name}' for name in names),
+            'directions': '1. Mix.\n2. Bake.'
+        })
+    return recipes
+
+
+@pytest.fixture(scope='session')
+def artifact_dir(tmp_path_factory) -> str:
+    """
+    A flat index of 300 recipes, with the dietary restrictions and the vocabulary of the repository.
+    """
+    output_dir = str(tmp_path_factory.mktemp('search'))
+    recipes = make_recipes(300)
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(faiss_index, 'SentenceTransformer', lambda model_name: HashModel())
+        embeddings = faiss_index.embed_stream(
+            lambda skip: iter(recipes[skip:]), output_dir, {'input_file': 'tests'}, total=len(recipes)
+        )
+    restrictions, vocabulary = faiss_index.read_build_inputs(
+        os.path.join(REPO_DIR, 'dietary_restriction_exclusion_lists.json'),
+        os.path.join(REPO_DIR, 'ingredient_vocabulary.json')
+    )
+    faiss_index.build_index(output_dir, embeddings, 'flat', restrictions, vocabulary)
+    return output_dir
+
+
+@pytest.fixture
+def artifact_copy(artifact_dir, tmp_path) -> str:
+    """
+    A copy of the index of artifact_dir, for tests that change it.
+    """
+    output_dir = str(tmp_path / 'search')
+    shutil.copytree(artifact_dir, output_dir)
+    return output_dir
+
+
+@pytest.fixture
+def hash_model(monkeypatch) -> None:
+    """
+    Let every search engine encode queries with HashModel.
+    """
+    monkeypatch.setattr(BaseSearchEngine, 'model', property(lambda self: HashModel()))
+
+
+@pytest.fixture
+def queries() -> list:
+    """
+    Searches in every mode, with and without keywords, avoided ingredients and dietary restrictions.
+    """
+    return [
+        {'user_ingredients': ['onion'], 'avoid_ingredients': [], 'user_keywords': '', 'top_k': 5},
+        {'user_ingredients': ['garlic', 'onion'], 'avoid_ingredients': ['butter'], 'user_keywords': 'soup',
+         'top_k': 10},
+        {'user_ingredients': ['chicken', 'rice'], 'avoid_ingredients': [], 'user_keywords': '', 'top_k': 8,
+         'restrictions': ['lactose_intolerance']},
+        {'user_ingredients': ['flour', 'sugar', 'egg', 'butter', 'milk'], 'avoid_ingredients': [],
+         'user_keywords': '', 'mode': 'exclusive', 'top_k': 10},
+        {'user_ingredients': ['tomato', 'cheese', 'beef'], 'avoid_ingredients': [], 'user_keywords': 'spicy',
+         'mode': 'coverage', 'top_k': 6},
+        {'user_ingredients': ['potato'], 'avoid_ingredients': ['salt'], 'user_keywords': 'baked', 'top_k': 3},
+    ]
@@ -0,0 +1,22 @@
+import json
+from batch_search import batch_search
+
+
+def run_batch_search(artifact_dir: str, tmp_path, queries: list, workers: int) -> list:
+    input_file = tmp_path / 'queries.jsonl'
+    output_file = tmp_path / f'results_{workers}.jsonl'
+    with open(input_file, 'w', encoding='utf-8') as f:
+        for pantry_id, query in enumerate(queries):
+            f.write(json.dumps(dict(query, pantry_id=pantry_id)) + '\n')
+    batch_search(str(input_file), str(output_file), artifact_dir, workers=workers, chunk_size=2)
+    with open(output_file, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_workers_write_results_in_input_order(artifact_dir, hash_model, queries, tmp_path):
+    queries = queries * 4  # more chunks than searches the workers hold at once
+    in_process = run_batch_search(artifact_dir, tmp_path, queries, workers=1)
+    parallel = run_batch_search(artifact_dir, tmp_path, queries, workers=2)
+
+    assert [line['pantry_id'] for line in parallel] == list(range(len(queries)))
+    assert parallel == in_process
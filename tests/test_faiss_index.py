@@ -0,0 +1,76 @@
+import json
+import pytest
+import faiss_index
+from recipe_store import RecipeStore
+from search import SearchEngine, CONFIG_FILE
+from conftest import HashModel
+
+
+@pytest.fixture
+def hash_build_model(monkeypatch) -> None:
+    """
+    Let faiss_index.py embed recipes with HashModel.
+    """
+    monkeypatch.setattr(faiss_index, 'SentenceTransformer', lambda model_name: HashModel())
+
+
+def add(output_dir: str, tmp_path, recipes: list) -> None:
+    input_file = tmp_path / 'add.jsonl'
+    with open(input_file, 'w', encoding='utf-8') as f:
+        for recipe in recipes:
+            f.write(json.dumps(recipe) + '\n')
+    faiss_index.add_recipes(str(input_file), output_dir)
+
+
+def new_recipe(title: str, **fields) -> dict:
+    return {'title': title, 'ingredients': '- 1 c. onion\n- 1 c. garlic', 'directions': '1. Mix.', **fields}
+
+
+def read_config(output_dir: str) -> dict:
+    with open(f'{output_dir}/{CONFIG_FILE}', 'r') as f:
+        return json.load(f)
+
+
+def test_add_gives_new_ids_after_the_ids_of_the_file(artifact_copy, hash_build_model, tmp_path, capsys):
+    add(artifact_copy, tmp_path, [new_recipe('Without an ID'), new_recipe('With an ID', id=300)])
+
+    store = RecipeStore(artifact_copy)
+    assert len(store) == 302
+    assert store[store.find(300)]['title'] == 'With an ID'
+    assert store[store.find(301)]['title'] == 'Without an ID'
+    assert read_config(artifact_copy)['next_recipe_id'] == 302
+    assert 'Added 2 recipes and updated 0 recipes.' in capsys.readouterr().out
+
+
+def test_add_replaces_changed_recipes_once(artifact_copy, hash_build_model, tmp_path, capsys):
+    store = RecipeStore(artifact_copy)
+    changed, unchanged = store[5], store[7]
+    add(artifact_copy, tmp_path, [
+        dict(changed, title='First change'), dict(changed, title='Second change'),
+        dict(unchanged, title='Reverted change'), unchanged
+    ])
+
+    store = RecipeStore(artifact_copy)
+    assert len(store) == 301
+    assert int(store.deleted.sum()) == 1
+    assert store[store.find(5)]['title'] == 'Second change'
+    assert store[store.find(7)] == unchanged
+    assert 'Added 0 recipes and updated 1 recipes.' in capsys.readouterr().out
+
+
+def test_delete_and_compact_keep_ids(artifact_copy, hash_model, queries):
+    deleted = set(range(0, 300, 3))
+    faiss_index.delete_recipes(artifact_copy, sorted(deleted))
+    searched = [SearchEngine(artifact_copy).search_faiss_and_filter(**query) for query in queries]
+    assert all(recipe['id'] not in deleted for results in searched for recipe in results)
+
+    faiss_index.compact(artifact_copy)
+    store = RecipeStore(artifact_copy)
+    assert len(store) == 200
+    assert not store.deleted.any()
+    assert store[store.find(4)]['title'] == 'Recipe 4'
+    assert read_config(artifact_copy)['next_recipe_id'] == 300
+
+    compacted = [SearchEngine(artifact_copy).search_faiss_and_filter(**query) for query in queries]
+    assert [[recipe['id'] for recipe in results] for results in compacted] == \
+        [[recipe['id'] for recipe in results] for results in searched]
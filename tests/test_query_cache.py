@@ -0,0 +1,40 @@
+import time
+import numpy as np
+from query_cache import QueryCache, EmbeddingCache
+
+
+def test_evicts_least_recently_used():
+    cache = QueryCache(maxsize=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'size': 2}
+
+
+def test_expires_entries():
+    cache = QueryCache(maxsize=10, ttl=0.05)
+    cache.put('a', 1)
+    time.sleep(0.1)
+    assert cache.get('a') is None
+
+
+def test_skips_values_computed_before_a_clear():
+    cache = QueryCache(maxsize=10, ttl=60)
+    generation = cache.generation
+    cache.clear()
+    cache.put('stale', 1, generation)
+    cache.put('fresh', 2, cache.generation)
+    assert cache.get('stale') is None
+    assert cache.get('fresh') == 2
+
+
+def test_persists_embeddings_per_model(tmp_path):
+    path = str(tmp_path / 'embeddings.db')
+    embedding = np.arange(4, dtype='float32')
+    EmbeddingCache('model', maxsize=10, ttl=60, path=path).put('onion', embedding)
+
+    assert np.array_equal(EmbeddingCache('model', maxsize=10, ttl=60, path=path).get('onion'), embedding)
+    assert EmbeddingCache('other model', maxsize=10, ttl=60, path=path).get('onion') is None
@@ -0,0 +1,23 @@
+import faiss_index
+from search import SearchEngine
+
+
+def recipe_ids(results) -> list:
+    return [recipe['id'] for recipe in results]
+
+
+def test_search_fetches_from_the_artifacts_it_ranked_with(artifact_copy, hash_model, queries):
+    expected = [recipe_ids(SearchEngine(artifact_copy).search_faiss_and_filter(**query)) for query in queries]
+    engine = SearchEngine(artifact_copy)
+    rank_many = engine.rank_many
+
+    def rank_then_compact(*args, **kwargs):
+        rankings = rank_many(*args, **kwargs)
+        faiss_index.delete_recipes(artifact_copy, list(range(200)))  # the store shrinks to 100 recipes
+        faiss_index.compact(artifact_copy)
+        assert engine.reload_if_changed()
+        return rankings
+
+    engine.rank_many = rank_then_compact
+    results = engine.search_many(queries)
+    assert [recipe_ids(result) for result in results] == expected
@@ -0,0 +1,43 @@
+import pytest
+from search import SearchEngine
+from search_service import SearchService
+
+
+def recipe_ids(results) -> list:
+    return [recipe['id'] for recipe in results]
+
+
+def test_batch_matches_single_searches(artifact_dir, hash_model, queries):
+    service = SearchService(SearchEngine(artifact_dir), window_ms=1000)
+    futures = [service.submit(**query) for query in queries]
+    batched = [future.result(timeout=60) for future in futures]
+    service.close()
+
+    single = SearchEngine(artifact_dir)
+    for query, results in zip(queries, batched):
+        expected = single.search_faiss_and_filter(**query)
+        assert recipe_ids(results) == recipe_ids(expected)
+        assert results.exhausted == expected.exhausted
+
+    stats = service.stats()
+    assert stats['requests'] == len(queries)
+    assert max(stats['batch_sizes']) > 1
+
+
+def test_failed_batch_falls_back_to_single_searches(artifact_dir, hash_model, queries):
+    failing = dict(queries[0], restrictions=['no such restriction'])
+    service = SearchService(SearchEngine(artifact_dir), window_ms=1000)
+    futures = [service.submit(**query) for query in queries + [failing]]
+    for future in futures[:-1]:
+        future.result(timeout=60)
+    with pytest.raises(ValueError):
+        futures[-1].result(timeout=60)
+    service.close()
+
+    single = SearchEngine(artifact_dir)
+    for query, future in zip(queries, futures):
+        assert recipe_ids(future.result()) == recipe_ids(single.search_faiss_and_filter(**query))
+
+    stats = service.stats()
+    assert stats['batch_sizes'] == {len(futures): 1}
+    assert stats['latency_ms']['failed_batch'] > 0
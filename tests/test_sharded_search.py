@@ -0,0 +1,45 @@
+import json
+import os
+import pytest
+import faiss_index
+from conftest import REPO_DIR, HashModel, make_recipes
+from search import SearchEngine
+from sharded_search import ShardedSearchEngine, open_engine
+
+
+@pytest.fixture(scope='session')
+def sharded_dir(tmp_path_factory) -> str:
+    """
+    The recipes of artifact_dir, split into three flat shards.
+    """
+    tmp_path = tmp_path_factory.mktemp('sharded')
+    input_file = tmp_path / 'recipes.jsonl'
+    with open(input_file, 'w', encoding='utf-8') as f:
+        for recipe in make_recipes(300):
+            f.write(json.dumps(recipe) + '\n')
+    output_dir = str(tmp_path / 'search')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(faiss_index, 'SentenceTransformer', lambda model_name: HashModel())
+        faiss_index.index_faiss(
+            str(input_file), output_dir, 'flat', shards=3,
+            dietary_json=os.path.join(REPO_DIR, 'dietary_restriction_exclusion_lists.json'),
+            vocabulary_json=os.path.join(REPO_DIR, 'ingredient_vocabulary.json')
+        )
+    return output_dir
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sharded_results_match_unsharded(artifact_dir, sharded_dir, hash_model, queries, workers):
+    engine = open_engine(sharded_dir, workers=workers)
+    assert isinstance(engine, ShardedSearchEngine)
+    try:
+        sharded = engine.search_many(queries)
+    finally:
+        engine.close()
+
+    unsharded = SearchEngine(artifact_dir).search_many(queries)
+    assert all(unsharded)
+    for results, expected in zip(sharded, unsharded):
+        assert [recipe['id'] for recipe in results] == [recipe['id'] for recipe in expected]
+        assert results == expected
+        assert results.exhausted == expected.exhausted
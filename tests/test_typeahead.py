@@ -0,0 +1,40 @@
+import pytest
+from typeahead import IngredientCompleter
+
+COUNTS = {'sugar': 50, 'brown sugar': 30, 'powdered sugar': 10, 'margarine': 20, 'broccoli': 15, 'chicken': 40,
+          'chicken broth': 25, 'cinnamon': 35, 'salt': 60}
+ALIASES = {'oleo': 'margarine', 'icing sugar': 'powdered sugar'}
+
+
+@pytest.fixture
+def completer() -> IngredientCompleter:
+    return IngredientCompleter(COUNTS, ALIASES)
+
+
+def test_completes_prefixes_of_every_word_most_common_first(completer):
+    assert completer.complete('bro', 3) == ['brown sugar', 'chicken broth', 'broccoli']
+    assert completer.complete('sug', 3) == ['sugar', 'brown sugar', 'powdered sugar']
+    assert completer.complete('  Chicken   BR', 1) == ['chicken broth']
+
+
+def test_completes_aliases_to_their_ingredient(completer):
+    assert completer.complete('oleo', 1) == ['margarine']
+    assert completer.complete('icing', 1) == ['powdered sugar']
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('suger', 'sugar'),
+    ('chiken', 'chicken'),
+    ('brocoli', 'broccoli'),
+    ('cinamon', 'cinnamon'),
+])
+def test_tolerates_typos(completer, text, expected):
+    assert completer.complete(text, 3)[0] == expected
+
+
+def test_short_texts_dont_match_everything(completer):
+    assert completer.complete('sx') == []
+
+
+def test_completes_the_most_common_ingredients_without_text(completer):
+    assert completer.complete('', 2) == ['salt', 'sugar']
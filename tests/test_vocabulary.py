@@ -0,0 +1,47 @@
+import pytest
+from vocabulary import Vocabulary, singularize, canonical_form
+
+
+@pytest.mark.parametrize('plural, singular', [
+    ('onions', 'onion'),
+    ('tomatoes', 'tomato'),
+    ('strawberries', 'strawberry'),
+    ('cookies', 'cookie'),
+    ('pies', 'pie'),
+    ('peaches', 'peach'),
+    ('radishes', 'radish'),
+    ('boxes', 'box'),
+    ('kisses', 'kiss'),
+    ('blintzes', 'blintz'),
+    ('quiches', 'quiche'),
+    ('cheeses', 'cheese'),
+    ('leaves', 'leaf'),
+    ('chilies', 'chili'),
+    ('molasses', 'molasses'),
+    ('asparagus', 'asparagus'),
+    ('egg', 'egg'),
+])
+def test_singularize(plural, singular):
+    assert singularize(plural) == singular
+
+
+@pytest.mark.parametrize('ingredient, canonical', [
+    ('Chopped  Onions', 'onion'),
+    ('fresh peaches', 'peach'),
+    ('chocolate chip cookies', 'chocolate chip cookie'),
+    ('butter or margarine', 'butter'),
+    ('colby or cheddar cheese', 'colby cheese'),
+    ('milk or more', 'milk'),
+    ('chopped', 'chopped'),
+])
+def test_canonical_form(ingredient, canonical):
+    assert canonical_form(ingredient) == canonical
+
+
+def test_overrides_apply_to_surface_and_canonical_forms():
+    vocabulary = Vocabulary.build(
+        {'oleo': 3, 'margarine': 2, 'green peppers': 4}, {'oleo': 'margarine', 'green pepper': 'green bell pepper'}
+    )
+    assert vocabulary.ingredients == ['margarine', 'green bell pepper']
+    assert vocabulary.counts == [5, 4]
+    assert vocabulary.lookup('oleo') == vocabulary.lookup('Margarine') == 0
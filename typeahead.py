@@ -0,0 +1,137 @@
+import bisect
+import json
+import numpy as np
+from vocabulary import Vocabulary
+
+TYPO_TRIGRAMS = 3  # the most trigrams of the typed text that one typo changes, e.g. "suger" loses uga, gar and ar
+
+
+def trigrams(text: str) -> set:
+    """
+    :param text: A lowercase string.
+    :return: The character trigrams of every word of the text, padded so word starts and ends count.
+    """
+    return set(
+        padded[i:i + 3] for word in text.split() for padded in [f'  {word} '] for i in range(len(padded) - 2)
+    )
+
+
+class IngredientCompleter:
+    """
+    Completes what a user has typed to the most common ingredients of the vocabulary, so the app only ever sends a
+    handful of options to the browser.
+    Prefix matches are found by binary search over the sorted word suffixes of every ingredient, e.g. "brown sugar"
+    is found by "bro" and by "sug". If there are too few of them, ingredients sharing character trigrams with the
+    typed text are added, which tolerates typos. Aliases complete to their canonical ingredient, e.g. "oleo" to
+    "margarine".
+    """
+
+    def __init__(self, counts: dict, aliases: dict = None):
+        """
+        :param counts: The number of recipes containing each ingredient, e.g. the contents of
+        cleaned_ingredients.json.
+        :param aliases: The canonical ingredient of other names of the ingredients, e.g. the aliases of the canonical
+        vocabulary.
+        """
+        self.names = sorted(counts)
+        self.counts = np.array([counts[name] for name in self.names], dtype=np.int64)
+        name_idxs = {name: name_idx for name_idx, name in enumerate(self.names)}
+        forms = list(enumerate(self.names)) + [
+            (name_idxs[name], alias) for alias, name in (aliases or {}).items() if name in name_idxs
+        ]
+
+        # every ingredient once per word of each of its names, keyed by the text from that word on
+        suffixes = sorted(set(
+            (' '.join(words[i:]), name_idx)
+            for name_idx, form in forms for words in [form.lower().split()] for i in range(len(words))
+        ))
+        self.suffixes = [suffix for suffix, _ in suffixes]
+        self.suffix_names = np.array([name_idx for _, name_idx in suffixes], dtype=np.int64)
+
+        # inverted index from each trigram to the ingredients containing it, like the ingredient postings
+        postings = {}
+        self.trigram_counts = np.zeros(len(self.names), dtype=np.int64)
+        for name_idx, name in enumerate(self.names):
+            grams = trigrams(name.lower())
+            self.trigram_counts[name_idx] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(name_idx)
+        self.trigram_postings = {gram: np.array(idxs, dtype=np.int64) for gram, idxs in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def load(cls, path: str) -> 'IngredientCompleter':
+        """
+        :param path: A .json file with the number of recipes containing each ingredient.
+        :return: The completer.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def from_vocabulary(cls, path: str) -> 'IngredientCompleter':
+        """
+        :param path: A .json file with the canonical ingredient vocabulary written by vocabulary.py.
+        :return: The completer of the canonical ingredients and their aliases.
+        """
+        vocabulary = Vocabulary.load(path)
+        return cls(vocabulary.counts_by_name(), vocabulary.aliases)
+
+    def most_common(self, name_idxs: np.ndarray, limit: int) -> list:
+        """
+        :param name_idxs: The positions of ingredients in names.
+        :param limit: The maximum number of ingredients to return.
+        :return: The most common of the ingredients, most common first.
+        """
+        if len(name_idxs) > limit:
+            name_idxs = name_idxs[np.argpartition(-self.counts[name_idxs], limit)[:limit]]
+        return [int(i) for i in name_idxs[np.argsort(-self.counts[name_idxs], kind='stable')]]
+
+    def prefix_matches(self, prefix: str, limit: int) -> list:
+        """
+        :param prefix: The typed text.
+        :param limit: The maximum number of ingredients to return.
+        :return: The positions of the most common ingredients with a word starting with the prefix.
+        """
+        start = bisect.bisect_left(self.suffixes, prefix)
+        end = bisect.bisect_left(self.suffixes, prefix + '\uffff', lo=start)
+        return self.most_common(np.unique(self.suffix_names[start:end]), limit)
+
+    def fuzzy_matches(self, text: str, limit: int) -> list:
+        """
+        :param text: The typed text.
+        :param limit: The maximum number of ingredients to return.
+        :return: The positions of the ingredients most similar to the text by trigram overlap, with ties broken by
+        how common they are. An ingredient must share all trigrams of the text but those one typo changes, and at
+        least half of them, so short texts don't match everything.
+        """
+        grams = trigrams(text)
+        postings = [self.trigram_postings[gram] for gram in grams if gram in self.trigram_postings]
+        if not postings:
+            return []
+
+        name_idxs, shared = np.unique(np.concatenate(postings), return_counts=True)
+        keep = shared >= max(len(grams) - TYPO_TRIGRAMS, (len(grams) + 1) // 2)
+        name_idxs, shared = name_idxs[keep], shared[keep]
+        similarity = shared / (len(grams) + self.trigram_counts[name_idxs] - shared)  # Jaccard similarity
+
+        order = np.lexsort((-self.counts[name_idxs], -similarity))[:limit]
+        return [int(i) for i in name_idxs[order]]
+
+    def complete(self, text: str, limit: int = 20) -> list:
+        """
+        :param text: What the user has typed.
+        :param limit: The maximum number of completions.
+        :return: The completions, best first. Without any typed text, the most common ingredients.
+        """
+        text = ' '.join(text.lower().split())
+        if not text:
+            return [self.names[i] for i in self.most_common(np.arange(len(self.names)), limit)]
+
+        matches = self.prefix_matches(text, limit)
+        if len(matches) < limit:
+            seen = set(matches)
+            matches += [i for i in self.fuzzy_matches(text, 2 * limit) if i not in seen][:limit - len(matches)]
+        return [self.names[i] for i in matches]
@@ -0,0 +1,255 @@
+import argparse
+import json
+import re
+from collections import Counter
+
+VOCABULARY_FILE = 'ingredient_vocabulary.json'
+OVERRIDES_FILE = 'ingredient_overrides.json'
+
+# preparation and size words that don't change which ingredient is meant
+modifiers = {'chopped', 'minced', 'diced', 'sliced', 'melted', 'softened', 'fresh', 'freshly', 'finely', 'coarsely',
+             'grated', 'shredded', 'packed', 'firmly', 'lightly', 'loosely', 'crushed', 'beaten', 'cooked', 'uncooked',
+             'peeled', 'cubed', 'thinly', 'halved', 'quartered', 'mashed', 'sifted', 'boiling', 'warm', 'cold',
+             'lukewarm', 'frozen', 'thawed', 'drained', 'rinsed', 'large', 'jumbo', 'about', 'approximately',
+             'more', 'additional', 'optional', 'heaping', 'scant', 'well', 'separated', 'room', 'temperature'}
+
+# plural endings that are part of the singular word, e.g. asparagus, hummus
+singular_endings = ('ss', 'us', 'is')
+irregular_plurals = {'leaves': 'leaf', 'halves': 'half', 'loaves': 'loaf', 'molasses': 'molasses', 'grits': 'grits',
+                     'chilies': 'chili', 'chillies': 'chilli', 'krispies': 'krispies', 'crispies': 'crispies',
+                     'wheaties': 'wheaties', 'quiches': 'quiche', 'brioches': 'brioche', 'ganaches': 'ganache'}
+# plural endings whose -es is not part of the singular word, e.g. peaches, radishes, boxes, kisses, blintzes
+es_endings = ('ches', 'shes', 'xes', 'sses', 'tzes', 'zzes')
+# plurals of words ending in -ie, which lose only the s, e.g. cookies, not the -ies of berries
+ie_plurals = {'cookies', 'pies', 'brownies', 'veggies', 'vegies', 'twinkies', 'smokies', 'toasties', 'wienies',
+              'jimmies', 'sandies', 'drummies', 'goodies', 'calories', 'crunchies', 'hoagies'}
+
+
+def singularize(word: str) -> str:
+    """
+    :param word: A lowercase word.
+    :return: The word with a regular English plural ending removed.
+    """
+    if word in irregular_plurals:
+        return irregular_plurals[word]
+    if len(word) <= 3 or word.endswith(singular_endings):
+        return word
+    if word.endswith('ies'):
+        return word[:-1] if word.split('-')[-1] in ie_plurals else word[:-3] + 'y'
+    if word.endswith(es_endings):
+        return word[:-2]
+    if word.endswith('oes'):
+        return word[:-2]
+    if word.endswith('s'):
+        return word[:-1]
+    return word
+
+
+def canonical_form(ingredient: str) -> str:
+    """
+    Collapse the surface forms of an ingredient by rules: preparation and size modifiers are removed, of alternatives
+    such as "butter or margarine" only the first is kept, and the last word is made singular.
+    :param ingredient: An ingredient as extracted by extract_ingredients.py.
+    :return: The canonical form of the ingredient.
+    """
+    text = ' '.join(ingredient.lower().split())
+    text = re.sub(r'\bor more\b.*', '', text).strip()
+    words = [word for word in text.split() if word not in modifiers]
+    if not words:  # only modifiers, e.g. "chopped"
+        return text
+
+    if 'or' in words:
+        i = words.index('or')
+        first, second = words[:i], words[i + 1:]
+        if len(first) == 1 and len(second) > 1:
+            first += second[1:]  # "colby or cheddar cheese" means "colby cheese"
+        words = first or second
+        if not words:
+            return text
+
+    words[-1] = singularize(words[-1])
+    return ' '.join(words)
+
+
+class Vocabulary:
+    """
+    The canonical ingredient vocabulary shared by indexing, filtering, the dietary restrictions and the app.
+    Every ingredient has a dense integer ID, its position in ingredients, which are sorted from most to least common.
+    A surface form is mapped to its canonical ingredient by canonical_form() and then by aliases, which hold the
+    reviewed merges of ingredient_overrides.json, e.g. "oleo" -> "margarine".
+    """
+
+    def __init__(self, ingredients: list, counts: list, aliases: dict):
+        """
+        :param ingredients: The canonical ingredient names, where an ingredient's ID is its position in the list.
+        :param counts: The number of occurrences of every canonical ingredient.
+        :param aliases: The canonical ingredient of surface forms or canonical forms that the rules don't collapse.
+        """
+        self.ingredients = ingredients
+        self.counts = counts
+        self.aliases = aliases
+        self.ids = {name: i for i, name in enumerate(ingredients)}
+
+    def __len__(self) -> int:
+        return len(self.ingredients)
+
+    def canonical(self, ingredient: str) -> str:
+        """
+        :param ingredient: A surface form of an ingredient.
+        :return: Its canonical name.
+        """
+        if ingredient in self.aliases:
+            return self.aliases[ingredient]
+        form = canonical_form(ingredient)
+        return self.aliases.get(form, form)
+
+    def lookup(self, ingredient: str):
+        """
+        :param ingredient: A surface form of an ingredient.
+        :return: The ID of its canonical ingredient, or None if it is not in the vocabulary.
+        """
+        return self.ids.get(self.canonical(ingredient))
+
+    def counts_by_name(self) -> dict:
+        """
+        :return: The number of occurrences of every canonical ingredient by name.
+        """
+        return dict(zip(self.ingredients, self.counts))
+
+    @classmethod
+    def build(cls, counts: dict, overrides: dict = None) -> 'Vocabulary':
+        """
+        Collapse the surface forms of a dataset into canonical ingredients.
+        :param counts: The number of occurrences of every surface form, e.g. the contents of cleaned_ingredients.json.
+        :param overrides: The reviewed canonical ingredient of surface or canonical forms, which take precedence
+        over the rules.
+        :return: The vocabulary.
+        """
+        vocabulary = cls([], [], dict(overrides or {}))
+        canonical_counts = Counter()
+        for ingredient, count in counts.items():
+            name = vocabulary.canonical(ingredient)
+            if name:
+                canonical_counts[name] += count
+
+        ingredients = sorted(canonical_counts, key=lambda name: (-canonical_counts[name], name))
+        return cls(ingredients, [canonical_counts[name] for name in ingredients], vocabulary.aliases)
+
+    def save(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'ingredients': self.ingredients, 'counts': self.counts, 'aliases': self.aliases}, f,
+                      ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'Vocabulary':
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['ingredients'], data['counts'], data['aliases'])
+
+
+def propose_merges(vocabulary: Vocabulary, model_name: str, threshold: float = 0.9, neighbours: int = 10,
+                   batch_size: int = 256) -> list:
+    """
+    Propose merges of canonical ingredients whose embeddings are nearly identical, e.g. "confectioners sugar" and
+    "powdered sugar", for review. Every ingredient is proposed to merge into its most similar more common one.
+    :param vocabulary: The vocabulary built by rules and the current overrides.
+    :param model_name: The name of the SentenceTransformer model that embeds the ingredient names.
+    :param threshold: The minimum cosine similarity of a proposed merge.
+    :param neighbours: The number of most similar ingredients considered per ingredient.
+    :param batch_size: The number of names the model encodes at once.
+    :return: The proposed merges, most similar first, each with the ingredient, its proposed canonical ingredient
+    and their similarity.
+    """
+    import faiss
+    from sentence_transformers import SentenceTransformer  # imports torch, so only when proposing
+
+    model = SentenceTransformer(model_name)
+    embeddings = model.encode(
+        vocabulary.ingredients, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True,
+        show_progress_bar=True
+    ).astype('float32')
+
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+    similarities, neighbour_ids = index.search(embeddings, neighbours + 1)
+
+    merges = []
+    for ingredient_id, (row_sims, row_ids) in enumerate(zip(similarities, neighbour_ids)):
+        # ingredients are sorted by count, so a lower ID is more common
+        targets = [(sim, j) for sim, j in zip(row_sims, row_ids) if 0 <= j < ingredient_id and sim >= threshold]
+        if targets:
+            sim, j = max(targets)
+            merges.append({
+                'ingredient': vocabulary.ingredients[ingredient_id],
+                'canonical': vocabulary.ingredients[j],
+                'similarity': round(float(sim), 4)
+            })
+
+    return sorted(merges, key=lambda merge: -merge['similarity'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='vocabulary.py',
+        description='Build the canonical ingredient vocabulary, or propose merges of similar ingredients for review.'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Build the canonical ingredient vocabulary.')
+    propose_parser = subparsers.add_parser('propose', help='Propose merges of ingredients with similar embeddings.')
+
+    for subparser in [build_parser, propose_parser]:
+        subparser.add_argument(
+            'input_json',
+            type=str,
+            help='A .json file containing the count of every extracted ingredient, e.g. cleaned_ingredients.json.'
+        )
+        subparser.add_argument(
+            '-o', '--overrides',
+            type=str,
+            default=OVERRIDES_FILE,
+            help='A .json file mapping ingredients to their reviewed canonical ingredient.'
+        )
+
+    build_parser.add_argument(
+        'output_json',
+        type=str,
+        nargs='?',
+        default=VOCABULARY_FILE,
+        help='The .json file in which the vocabulary should be written.'
+    )
+    propose_parser.add_argument(
+        'output_json',
+        type=str,
+        help='The .json file in which the proposed merges should be written for review.'
+    )
+    propose_parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.9,
+        help='The minimum cosine similarity of two ingredients to propose merging them.'
+    )
+    propose_parser.add_argument(
+        '--model_name',
+        type=str,
+        default='all-MiniLM-L6-v2',
+        help='The SentenceTransformer model that embeds the ingredient names.'
+    )
+    args = parser.parse_args()
+
+    with open(args.input_json, 'r', encoding='utf-8') as f:
+        surface_counts = json.load(f)
+    with open(args.overrides, 'r', encoding='utf-8') as f:
+        reviewed = json.load(f)
+
+    built = Vocabulary.build(surface_counts, reviewed)
+
+    if args.command == 'build':
+        built.save(args.output_json)
+        print(f'Collapsed {len(surface_counts)} ingredients into {len(built)} canonical ingredients.')
+
+    elif args.command == 'propose':
+        proposed = propose_merges(built, args.model_name, args.threshold)
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump(proposed, f, ensure_ascii=False, indent=2)
+        print(f'Proposed {len(proposed)} merges. Add the correct ones to {args.overrides} and rebuild the vocabulary.')